@@ -10,6 +10,7 @@ setup(
     install_requires=[
         'setuptools',
         'xappy',
+        'futures',
         'transaction',
         'grokcore.component',
         'zope.schema',
@@ -26,6 +27,13 @@ setup(
     '': ['*.txt', '*.zcml'],
     },
     zip_safe=False,
+    entry_points={
+        'console_scripts': [
+            'dolmen-xapian-reindex = dolmen.xapian.reindex:main',
+            'dolmen-xapian-benchmark = dolmen.xapian.benchmark:main',
+            'dolmen-xapian-indexer = dolmen.xapian.daemon:main',
+            ],
+        },
     classifiers = [
         'Intended Audience :: Developers',
         'Framework :: Zope3'
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Searching without blocking the calling thread.
+
+An `AsyncIndexSearch` runs searches, query parsing and result
+resolution in worker threads of its own, and returns a `SearchFuture`
+at once. The number of workers and the size of the connection pool are
+set independently:
+
+  searcher = AsyncIndexSearch(index_path, workers=4, pool_size=8,
+                              timeout=2.0)
+  future = searcher.search(u'elephant', 0, 10)
+  future.add_done_callback(render)
+
+The futures are `concurrent.futures` futures (from the `futures`
+backport), so `concurrent.futures.wait` and `as_completed` apply, and
+an asyncio loop can await them through `asyncio.wrap_future`. Done
+callbacks are called in the worker thread.
+
+Futures can be cancelled until a worker picks them up. A search which
+did not complete within its timeout fails with `SearchTimeout`, a
+`concurrent.futures.TimeoutError`, and its worker result is discarded.
+"""
+
+import heapq
+import logging
+import sys
+import threading
+import time
+
+from concurrent import futures
+
+from dolmen.xapian.search import IndexSearch
+from dolmen.xapian.results import resolve_results
+
+log = logging.getLogger('dolmen.xapian')
+
+
+class SearchTimeout(futures.TimeoutError):
+    """The search did not complete in time.
+    """
+
+
+class SearchFuture(futures.Future):
+    """The eventual outcome of a call run by a `SearchExecutor`.
+
+    The outcome is set either by the worker running the call or by the
+    watchdog when the call times out, whichever comes first.
+    """
+
+    def __init__(self):
+        futures.Future.__init__(self)
+        self.settling = threading.RLock()
+
+    def cancel(self):
+        self.settling.acquire()
+        try:
+            return futures.Future.cancel(self)
+        finally:
+            self.settling.release()
+
+    def start(self):
+        """Marks the call as running, returns False if it was cancelled
+        or timed out meanwhile.
+        """
+        self.settling.acquire()
+        try:
+            if self.done():
+                return False
+            return self.set_running_or_notify_cancel()
+        finally:
+            self.settling.release()
+
+    def settle(self, value=None, error=None):
+        """Sets the outcome, unless the future is already done, ie. it
+        timed out meanwhile.
+        """
+        self.settling.acquire()
+        try:
+            if self.done():
+                return
+            if error is not None:
+                self.set_exception(error)
+            else:
+                self.set_result(value)
+        finally:
+            self.settling.release()
+
+    def expire(self):
+        """Fails the future with a timeout, unless it is done.
+        """
+        self.settle(error=SearchTimeout("Search timed out"))
+
+
+class Watchdog(threading.Thread):
+    """Fails the futures still not done at their deadline.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.deadlines = []
+        self.condition = threading.Condition()
+        self.running = True
+
+    def watch(self, future, timeout):
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.deadlines, (time.time() + timeout, future))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while self.running:
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, future = heapq.heappop(self.deadlines)
+                    future.expire()
+                if self.deadlines:
+                    self.condition.wait(self.deadlines[0][0] - now)
+                else:
+                    self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+
+class SearchExecutor(object):
+    """Runs calls in a thread pool, returning futures which can time
+    out.
+    """
+
+    def __init__(self, workers=4):
+        self.pool = futures.ThreadPoolExecutor(workers)
+        self.watchdog = Watchdog()
+        self.watchdog.start()
+
+    def run(self, future, function, args, kwargs):
+        if not future.start():
+            return
+        try:
+            value = function(*args, **kwargs)
+        except:
+            future.settle(error=sys.exc_info()[1])
+        else:
+            future.settle(value)
+
+    def submit(self, function, *args, **kwargs):
+        """Queues a call, failing its future if it isn't done within
+        `timeout` seconds when given.
+        """
+        timeout = kwargs.pop('timeout', None)
+        future = SearchFuture()
+        if timeout is not None:
+            self.watchdog.watch(future, timeout)
+        self.pool.submit(self.run, future, function, args, kwargs)
+        return future
+
+    def shutdown(self):
+        self.pool.shutdown()
+        self.watchdog.stop()
+        self.watchdog.join()
+
+
+class AsyncIndexSearch(object):
+    """An index search returning futures.
+    """
+
+    def __init__(self, index_path, workers=4, pool_size=None, cache=None,
+                 timeout=None):
+        self.index = IndexSearch(index_path, pool_size, cache)
+        self.executor = SearchExecutor(workers)
+        # default timeout of the calls, in seconds
+        self.timeout = timeout
+
+    def _submit(self, function, args, kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.executor.submit(function, *args, **kwargs)
+
+    def _search(self, query, startrank, endrank, **options):
+        if isinstance(query, basestring):
+            with self.index.connection() as conn:
+                query = conn.query_parse(query)
+        return self.index.search(query, startrank, endrank, **options)
+
+    def _query_parse(self, text, **options):
+        with self.index.connection() as conn:
+            return conn.query_parse(text, **options)
+
+    def search(self, query, startrank, endrank, **options):
+        """Searches for a query or a query string, the future gives
+        detached results (see `IndexSearch.search`).
+        """
+        return self._submit(
+            self._search, (query, startrank, endrank), options)
+
+    def query_parse(self, text, **options):
+        return self._submit(self._query_parse, (text,), options)
+
+    def objects(self, results, cache=None, timeout=None):
+        """Resolves search results to their objects.
+        """
+        options = {}
+        if timeout is not None:
+            options['timeout'] = timeout
+        return self._submit(resolve_results, (results, cache), options)
+
+    def invalidate(self):
+        self.index.invalidate()
+
+    def close(self):
+        self.executor.shutdown()
+        self.index.hub.close()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""Indexing and search benchmarks.
+
+Runs against a temporary index with synthetic content held by an in
+memory resolver, no external service is needed. It measures:
+
+ - the cost per event of the enqueue path, from the object event to
+   the operation buffer and the index queue, without indexing,
+
+ - indexing throughput, from object events through the operation
+   buffer, the index queue and the queue processor, until the last
+   document is searchable,
+
+ - index lag, from a transaction commit until its document is
+   searchable,
+
+ - search latency through a `ConnectionHub` used by concurrent
+   reader threads.
+
+Results are printed as JSON, to be compared between runs:
+
+  dolmen-xapian-benchmark --documents 20000 > before.json
+"""
+
+import sys
+import time
+import json
+import random
+import shutil
+import optparse
+import tempfile
+import threading
+import transaction
+import xappy
+import grokcore.component as grok
+import zope.component.event
+import dolmen.xapian
+
+from zope import interface, schema
+from zope.component import provideAdapter, provideHandler, provideUtility
+from zope.configuration import xmlconfig
+from zope.event import notify
+from zope.lifecycleevent import ObjectAddedEvent
+from dolmen.xapian import queue
+from dolmen.xapian.interfaces import (
+    IIndexable, IOperationFactory, IResolver, IEnumerableResolver,
+    IBulkResolver)
+from dolmen.xapian.operation import OperationFactory
+from dolmen.xapian.search import ConnectionHub
+
+RESOLVER = 'benchmark'
+
+VOCABULARY = [u'%s%s' % (a, b) for a in (
+    u'alpha', u'bravo', u'charlie', u'delta', u'echo', u'foxtrot',
+    u'golf', u'hotel', u'india', u'juliet', u'kilo', u'lima')
+    for b in range(50)]
+
+
+class IBenchmarkContent(interface.Interface):
+    title = schema.TextLine(title=u"Title")
+    body = schema.Text(title=u"Body")
+
+
+class Content(object):
+    interface.implements(IBenchmarkContent, IIndexable)
+    __parent__ = None
+
+    def __init__(self, id, title, body):
+        self.id = self.__name__ = id
+        self.title = title
+        self.body = body
+
+
+class MemoryResolver(object):
+    interface.implements(IEnumerableResolver, IBulkResolver)
+    scheme = RESOLVER
+
+    def __init__(self):
+        self.objects = {}
+
+    def id(self, object):
+        return object.id
+
+    def resolve(self, document_id):
+        return self.objects.get(document_id)
+
+    def resolve_many(self, document_ids):
+        get = self.objects.get
+        return dict((id, get(id)) for id in document_ids)
+
+    def ids(self):
+        return sorted(self.objects)
+
+
+class BenchmarkOperationFactory(OperationFactory):
+    grok.baseclass()
+    resolver_id = RESOLVER
+
+
+def generate(count, mean_size, sigma, rng, prefix='doc'):
+    """Yields content with bodies of log-normally distributed sizes
+    averaging `mean_size` bytes.
+    """
+    for number in xrange(count):
+        size = int(rng.lognormvariate(0, sigma) * mean_size)
+        words = []
+        length = 0
+        while length < size:
+            word = rng.choice(VOCABULARY)
+            words.append(word)
+            length += len(word) + 1
+        yield Content('%s-%d' % (prefix, number),
+                      u' '.join(rng.sample(VOCABULARY, 3)),
+                      u' '.join(words))
+
+
+def configure(resolver):
+    xmlconfig.file('configure.zcml', package=dolmen.xapian)
+    provideHandler(zope.component.event.objectEventNotify)
+    provideUtility(resolver, IResolver, name=RESOLVER)
+    provideAdapter(BenchmarkOperationFactory, (IBenchmarkContent,),
+                   IOperationFactory)
+
+
+def create_index(path):
+    connection = xappy.IndexerConnection(path)
+    actions = xappy.FieldActions
+    connection.add_field_action('resolver', actions.INDEX_EXACT)
+    connection.add_field_action('resolver', actions.STORE_CONTENT)
+    connection.add_field_action('title', actions.INDEX_FREETEXT)
+    connection.add_field_action('title', actions.STORE_CONTENT)
+    connection.add_field_action('body', actions.INDEX_FREETEXT)
+    connection.flush()
+    return connection
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def wait_for(path, document_id, timeout=300, delay=0.01):
+    """Waits until the document is searchable, returns when it was.
+    """
+    searcher = xappy.SearchConnection(path)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            searcher.reopen()
+            try:
+                searcher.get_document(document_id)
+            except KeyError:
+                time.sleep(delay)
+                continue
+            return time.time()
+        raise RuntimeError("%s not indexed after %ss" % (document_id, timeout))
+    finally:
+        searcher.close()
+
+
+def bench_enqueue(resolver, contents, transaction_size):
+    """Times the events and the commits queueing their operations,
+    against an index queue nothing reads.
+    """
+    previous = queue.index_queue
+    queue.set_queue(queue.IndexQueue())
+    events = commits = 0.0
+    count = 0
+    try:
+        for ob in contents:
+            resolver.objects[ob.id] = ob
+            started = time.time()
+            notify(ObjectAddedEvent(ob))
+            events += time.time() - started
+            count += 1
+            if count % transaction_size == 0:
+                started = time.time()
+                transaction.commit()
+                commits += time.time() - started
+        started = time.time()
+        transaction.commit()
+        commits += time.time() - started
+    finally:
+        queue.index_queue = previous
+        resolver.objects.clear()
+    transactions = -(-count // transaction_size)
+    return dict(operations=count,
+                event_microseconds=events / max(count, 1) * 1e6,
+                commit_microseconds=commits / max(transactions, 1) * 1e6,
+                per_operation_microseconds=(
+                    (events + commits) / max(count, 1) * 1e6))
+
+
+def bench_indexing(path, resolver, contents, transaction_size):
+    started = time.time()
+    count = 0
+    last = None
+    for ob in contents:
+        resolver.objects[ob.id] = ob
+        notify(ObjectAddedEvent(ob))
+        count += 1
+        last = ob
+        if count % transaction_size == 0:
+            transaction.commit()
+    transaction.commit()
+    enqueued = time.time()
+    indexed = wait_for(path, last.id)
+    return dict(operations=count,
+                enqueue_seconds=enqueued - started,
+                enqueue_per_second=count / max(enqueued - started, 1e-6),
+                seconds=indexed - started,
+                operations_per_second=count / max(indexed - started, 1e-6))
+
+
+def bench_lag(path, resolver, contents):
+    lags = []
+    for ob in contents:
+        resolver.objects[ob.id] = ob
+        notify(ObjectAddedEvent(ob))
+        transaction.commit()
+        committed = time.time()
+        lags.append(wait_for(path, ob.id) - committed)
+    return dict(samples=len(lags), mean=sum(lags) / max(len(lags), 1),
+                p50=percentile(lags, 0.5), p99=percentile(lags, 0.99))
+
+
+def bench_search(path, threads, duration, rng):
+    hub = ConnectionHub(path, pool_size=threads)
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    words = [rng.choice(VOCABULARY) for i in range(1000)]
+
+    def read():
+        local_latencies = []
+        position = rng.randint(0, len(words) - 1)
+        while time.time() < deadline:
+            position = (position + 1) % len(words)
+            started = time.time()
+            with hub.connection() as conn:
+                query = conn.query_parse(words[position])
+                list(conn.search(query, 0, 10))
+            local_latencies.append(time.time() - started)
+        lock.acquire()
+        latencies.extend(local_latencies)
+        lock.release()
+
+    readers = [threading.Thread(target=read) for i in range(threads)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    hub.close()
+    return dict(threads=threads, queries=len(latencies),
+                queries_per_second=len(latencies) / float(duration),
+                mean=sum(latencies) / max(len(latencies), 1),
+                p50=percentile(latencies, 0.5),
+                p99=percentile(latencies, 0.99))
+
+
+def run(documents=10000, mean_size=2000, sigma=1.0, transaction_size=100,
+        lag_samples=5, threads=8, duration=10, seed=0):
+    parameters = dict(locals())
+    parameters['processor'] = dict(
+        (name, getattr(queue.QueueProcessor, name)) for name in (
+            'FLUSH_THRESHOLD', 'FLUSH_BYTES', 'FLUSH_INTERVAL',
+            'BATCH_SIZE', 'BATCH_TIMEOUT'))
+    rng = random.Random(seed)
+    path = tempfile.mkdtemp(prefix='dolmen-xapian-benchmark-')
+    resolver = MemoryResolver()
+    configure(resolver)
+    connection = create_index(path)
+    enqueue = bench_enqueue(
+        resolver, generate(documents, mean_size, sigma,
+                           random.Random(seed), prefix='enqueue'),
+        transaction_size)
+    queue.QueueProcessor.start(connection)
+    try:
+        indexing = bench_indexing(
+            path, resolver, generate(documents, mean_size, sigma, rng),
+            transaction_size)
+        lag = bench_lag(
+            path, resolver,
+            generate(lag_samples, mean_size, sigma, rng, prefix='lag'))
+        search = bench_search(path, threads, duration, rng)
+    finally:
+        queue.QueueProcessor.stop()
+        connection.close()
+        shutil.rmtree(path)
+    return dict(parameters=parameters, enqueue=enqueue, indexing=indexing,
+                lag=lag, search=search)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        description="Benchmarks dolmen.xapian indexing and searching.")
+    parser.add_option('--documents', type='int', default=10000)
+    parser.add_option('--mean-size', type='int', default=2000,
+                      help="mean body size in bytes [default: %default]")
+    parser.add_option('--sigma', type='float', default=1.0,
+                      help="spread of the body sizes [default: %default]")
+    parser.add_option('--transaction-size', type='int', default=100)
+    parser.add_option('--lag-samples', type='int', default=5)
+    parser.add_option('--threads', type='int', default=8,
+                      help="concurrent search threads [default: %default]")
+    parser.add_option('--duration', type='float', default=10,
+                      help="search benchmark seconds [default: %default]")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-o', '--output', help="write the results to a file")
+    options, args = parser.parse_args(argv)
+
+    results = run(documents=options.documents, mean_size=options.mean_size,
+                  sigma=options.sigma,
+                  transaction_size=options.transaction_size,
+                  lag_samples=options.lag_samples, threads=options.threads,
+                  duration=options.duration, seed=options.seed)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        fh = open(options.output, 'w')
+        fh.write(output + '\n')
+        fh.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
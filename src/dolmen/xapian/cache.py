@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Search result caching.
+
+`IndexSearch.search` memoizes result sets in a `ResultCache` when it has
+one. Entries are keyed on the query, the requested ranks and the search
+options, and belong to an index revision: once the revision advances,
+the whole cache is dropped.
+
+The cached result sets are detached from the connection: their
+suggested facets are only available when the search asked for them.
+"""
+
+import time
+
+from collections import OrderedDict
+from threading import Lock
+from dolmen.xapian.results import get_resolver, resolver_of, resolve_results
+
+
+class CachedResult(object):
+    """A detached search result: document id, rank and stored fields.
+    """
+    __slots__ = ('id', 'rank', 'weight', 'percent', 'data')
+
+    def __init__(self, result):
+        self.id = result.id
+        self.rank = result.rank
+        self.weight = getattr(result, 'weight', None)
+        self.percent = getattr(result, 'percent', None)
+        self.data = dict(result.data)
+
+    @property
+    def resolver_id(self):
+        return resolver_of(self)
+
+    def object(self):
+        return get_resolver(self.resolver_id).resolve(self.id)
+
+    def size(self):
+        size = len(self.id)
+        for values in self.data.values():
+            for value in values:
+                size += len(value)
+        return size
+
+
+class CachedResults(list):
+    """A detached result set. The suggested facets are kept when the
+    arguments of `get_suggested_facets` are given as `facets`.
+    """
+    ATTRIBUTES = ('startrank', 'endrank', 'more_matches',
+                  'matches_lower_bound', 'matches_upper_bound',
+                  'matches_estimated', 'estimate_is_exact')
+
+    def __init__(self, results, facets=None):
+        list.__init__(self, (CachedResult(result) for result in results))
+        for name in self.ATTRIBUTES:
+            setattr(self, name, getattr(results, name, None))
+        self.facets = None
+        if facets is not None:
+            self.facets = results.get_suggested_facets(**facets)
+
+    def get_suggested_facets(self):
+        if self.facets is None:
+            raise ValueError("The search did not ask for facets")
+        return self.facets
+
+    def size(self):
+        return sum(result.size() for result in self)
+
+    def objects(self, cache=None):
+        """Resolves the results, in bulk where resolvers allow it.
+        """
+        return resolve_results(self, cache)
+
+
+class ResultCache(object):
+    """A LRU cache of result sets, bounded in entries and in bytes,
+    with entries expiring after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024,
+                 ttl=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.revision = None
+
+    def key(self, query, startrank, endrank, options):
+        return (str(query), startrank, endrank, repr(sorted(options.items())))
+
+    def _advance(self, revision):
+        """Drops the entries of older revisions. Returns False if the
+        given revision is the older one.
+        """
+        if self.revision is not None and revision < self.revision:
+            return False
+        if revision != self.revision:
+            self.evictions += len(self.entries)
+            self.clear()
+            self.revision = revision
+        return True
+
+    def get(self, key, revision):
+        self.lock.acquire()
+        try:
+            entry = None
+            if self._advance(revision):
+                entry = self.entries.pop(key, None)
+            if entry is not None:
+                expires, size, results = entry
+                if expires > time.time():
+                    # most recently used go last
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return results
+                self.bytes -= size
+                self.evictions += 1
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+
+    def set(self, key, revision, results):
+        size = results.size()
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if not self._advance(revision):
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (time.time() + self.ttl, size, results)
+            self.bytes += size
+            while (len(self.entries) > self.max_entries or
+                   self.bytes > self.max_bytes):
+                expires, size, results = self.entries.popitem(False)[1]
+                self.bytes -= size
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.entries),
+                    bytes=self.bytes, revision=self.revision)
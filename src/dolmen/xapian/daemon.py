@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Indexing in a process of its own.
+
+Application processes starting a queue processor each open the index
+for writing, and wait on each other for its lock. Instead, a single
+indexer daemon can own the index connection and take the operations of
+all the application processes:
+
+  dolmen-xapian-indexer --zcml site.zcml --socket /var/run/app/indexer \\
+      --spool /var/spool/app/index /var/lib/app/index
+
+and the application processes ship their operations to it, one batch
+per transaction, instead of running a queue processor:
+
+  queue.set_queue(daemon.RemoteQueue(
+      '/var/run/app/indexer', spool_path='/var/spool/app/index'))
+
+Operations travel as (kind, oid, resolver_id, lane, attributes), the
+daemon resolves the content itself. Over the Unix socket, each request
+and reply is a JSON line. When the daemon can't be reached, batches are
+written to the spool directory when one is given, the daemon queues
+them once it is back. `operation.wait_for_indexed` works over the
+socket only.
+
+Batches are applied in the order they were sent: once a process
+spooled a batch, it keeps spooling until the daemon drained the spool,
+and the daemon drains the spool before queueing a batch sent over the
+socket. Each batch carries an id, so that one spooled after its
+request timed out isn't queued twice.
+"""
+
+import os
+import sys
+import json
+import uuid
+import time
+import errno
+import signal
+import socket
+import logging
+import optparse
+import threading
+import SocketServer
+
+from dolmen.xapian import operation, queue
+from dolmen.xapian.results import ObjectCache
+
+log = logging.getLogger('dolmen.xapian')
+
+
+def dump(op):
+    attributes = op.attributes
+    if attributes is not None:
+        attributes = sorted(attributes)
+    return [op.kind, op.oid, op.resolver_id, op.lane, attributes]
+
+
+def load(entry):
+    kind, oid, resolver_id, lane, attributes = entry
+    op = operation.restore(kind, oid, resolver_id)
+    op.lane = lane
+    if attributes is not None:
+        op.attributes = frozenset(attributes)
+    return op
+
+
+class RemoteQueue(object):
+    """The index queue of an application process, shipping operations
+    to an indexer daemon.
+    """
+
+    # seconds to wait for the daemon to acknowledge a batch
+    timeout = 10
+
+    def __init__(self, socket_path=None, spool_path=None):
+        if socket_path is None and spool_path is None:
+            raise ValueError("A socket or a spool directory is required")
+        self.socket_path = socket_path
+        self.spool_path = spool_path
+        self.local = threading.local()
+        self.spooled = 0
+        # spooled batches may be waiting for the daemon
+        self.spooling = False
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.local.socket = sock
+        self.local.reader = sock.makefile('r')
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self.local, 'socket', None)
+        if sock is not None:
+            self.local.reader.close()
+            sock.close()
+        self.local.socket = self.local.reader = None
+
+    def request(self, request, timeout=None, blocking=False):
+        """Sends a request and returns the reply, waiting `timeout`
+        seconds more than usual for it, or as long as it takes when
+        `blocking`.
+        """
+        sock = getattr(self.local, 'socket', None)
+        try:
+            if sock is None:
+                sock = self._connect()
+            if blocking:
+                sock.settimeout(None)
+            else:
+                sock.settimeout(self.timeout + (timeout or 0))
+            sock.sendall(json.dumps(request) + '\n')
+            line = self.local.reader.readline()
+            if not line:
+                raise socket.error(errno.ECONNRESET, "Indexer went away")
+            return json.loads(line)
+        except:
+            self._disconnect()
+            raise
+
+    def spool(self, batch, entries):
+        """Writes a batch to the spool directory, for the daemon to
+        pick it up.
+        """
+        self.spooling = True
+        self.spooled += 1
+        name = '%020d-%d-%d-%d.batch' % (
+            time.time() * 1000000, os.getpid(),
+            threading.current_thread().ident, self.spooled)
+        filename = os.path.join(self.spool_path, name)
+        fh = open(filename + '.tmp', 'w')
+        try:
+            json.dump(dict(batch=batch, ops=entries), fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        os.rename(filename + '.tmp', filename)
+
+    def put(self, op, block=True, timeout=None):
+        self.put_many([op])
+
+    def put_many(self, ops):
+        entries = [dump(op) for op in ops]
+        if not entries:
+            return
+        self.local.mark = None
+        batch = uuid.uuid4().hex
+        if self.socket_path is not None and not self.pending():
+            try:
+                self.local.mark = self.request(
+                    dict(ops=entries, batch=batch))['mark']
+                return
+            except (socket.error, IOError, ValueError, KeyError):
+                if self.spool_path is None:
+                    raise
+                log.warn("Indexer unreachable, spooling %s operations" %
+                         len(entries))
+        # the daemon may have queued it already, it knows the id
+        self.spool(batch, entries)
+
+    def pending(self):
+        """Tells if batches spooled by this process are still waiting
+        for the daemon, later ones must be spooled behind them.
+        """
+        if not self.spooling:
+            return False
+        self.spooling = any(name.endswith('.batch') for name in
+                            os.listdir(self.spool_path))
+        return self.spooling
+
+    def mark(self, ops):
+        return getattr(self.local, 'mark', None)
+
+    def wait(self, mark, timeout=None):
+        if mark is None:
+            # spooled, can't tell
+            return False
+        return self.request(dict(wait=mark, timeout=timeout), timeout,
+                            blocking=timeout is None)['indexed']
+
+    def status(self):
+        return self.request(dict(status=True))
+
+    def qsize(self):
+        return 0
+
+    def empty(self):
+        return True
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self._disconnect()
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                reply = self.server.daemon.dispatch(json.loads(line))
+            except Exception, error:
+                log.exception("Indexer daemon: bad request")
+                reply = dict(error=str(error))
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class IndexerDaemon(object):
+    """Owns the index connection, and queues the operations it gets
+    over a Unix socket or from a spool directory.
+    """
+
+    # Look for spooled batches every _n_ seconds
+    SPOOL_INTERVAL = 1
+
+    # Remember the ids of the last _n_ batches, not to queue them twice
+    BATCHES = 10000
+
+    def __init__(self, connection, socket_path=None, spool_path=None,
+                 pipeline=None, retry=None):
+        self.connection = connection
+        self.socket_path = socket_path
+        self.spool_path = spool_path
+        self.pipeline = pipeline
+        self.retry = retry
+        self.server = None
+        self.running = False
+        self.stopped = threading.Event()
+        # taken to queue batches, in order
+        self.lock = threading.RLock()
+        self.batches = ObjectCache(self.BATCHES)
+
+    def put(self, entries, batch=None):
+        """Queues a batch of operations, unless it was already queued,
+        and returns what to wait for to see it indexed.
+        """
+        self.lock.acquire()
+        try:
+            if batch is not None and batch in self.batches:
+                return self.batches.get(batch)
+            ops = [load(entry) for entry in entries]
+            index_queue = queue.index_queue
+            for op in ops:
+                index_queue.put(op)
+            mark = ops and index_queue.mark(ops) or None
+            if batch is not None:
+                self.batches.set(batch, mark)
+            return mark
+        finally:
+            self.lock.release()
+
+    def dispatch(self, request):
+        if 'ops' in request:
+            if self.spool_path is not None:
+                # spooled before this one was sent
+                self.drain_spool()
+            return dict(mark=self.put(request['ops'],
+                                      request.get('batch')))
+        if 'wait' in request:
+            return dict(indexed=queue.index_queue.wait(
+                request['wait'], request.get('timeout')))
+        if 'status' in request:
+            return queue.status()
+        raise ValueError("Unknown request %r" % sorted(request))
+
+    def drain_spool(self):
+        """Queues the spooled batches, oldest first.
+        """
+        self.lock.acquire()
+        try:
+            names = sorted(name for name in os.listdir(self.spool_path)
+                           if name.endswith('.batch'))
+            for name in names:
+                filename = os.path.join(self.spool_path, name)
+                try:
+                    fh = open(filename)
+                    try:
+                        batch = json.load(fh)
+                    finally:
+                        fh.close()
+                    self.put(batch['ops'], batch['batch'])
+                except Exception:
+                    # kept aside, not to be retried on every restart
+                    log.exception("Indexer daemon: damaged batch %s" % name)
+                    os.rename(filename, filename + '.damaged')
+                    continue
+                os.remove(filename)
+            return len(names)
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.running = True
+        queue.QueueProcessor.start(self.connection, pipeline=self.pipeline,
+                                   retry=self.retry)
+        if self.spool_path is not None:
+            if not os.path.isdir(self.spool_path):
+                os.makedirs(self.spool_path)
+            # ahead of the batches sent over the socket
+            self.drain_spool()
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                # left by a previous run
+                os.remove(self.socket_path)
+            self.server = Server(self.socket_path, RequestHandler)
+            self.server.daemon = self
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+
+    def serve(self):
+        """Runs until `stop` is called, picking up spooled batches.
+        """
+        self.start()
+        while self.running:
+            if self.spool_path is not None:
+                self.drain_spool()
+            self.stopped.wait(self.SPOOL_INTERVAL)
+        self.shutdown()
+
+    def stop(self, *args):
+        self.running = False
+        self.stopped.set()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socket_path)
+        if self.spool_path is not None:
+            self.drain_spool()
+        queue.QueueProcessor.stop()
+        queue.index_queue.close()
+
+
+def main(argv=None):
+    from dolmen.xapian.reindex import resolve_dotted
+    parser = optparse.OptionParser(
+        usage="%prog [options] INDEX_PATH",
+        description="Runs the indexer writing to a dolmen.xapian index for "
+                    "other processes.")
+    parser.add_option(
+        '-c', '--zcml', help="ZCML file registering resolvers and indexers")
+    parser.add_option('-s', '--socket', help="Unix socket to listen on")
+    parser.add_option(
+        '-d', '--spool', help="directory to pick operation batches from")
+    parser.add_option(
+        '-j', '--journal', help="directory journaling the index queue")
+    parser.add_option(
+        '--setup',
+        help="dotted name of the function adding the field actions of a "
+             "new index")
+    parser.add_option(
+        '-p', '--processes', type='int', default=0,
+        help="number of document preparation processes [default: none]")
+    parser.add_option(
+        '-r', '--retries', type='int', default=5,
+        help="attempts per operation, 0 to not retry [default: %default]")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or not (options.socket or options.spool):
+        parser.error("an index path and a socket or a spool are required")
+
+    logging.basicConfig(level=logging.INFO)
+    if options.zcml:
+        from zope.configuration import xmlconfig
+        xmlconfig.file(options.zcml)
+
+    import xappy
+    index_path = args[0]
+    created = not os.path.exists(index_path)
+    connection = xappy.IndexerConnection(index_path)
+    if created and options.setup:
+        resolve_dotted(options.setup)(connection)
+        connection.flush()
+
+    if options.journal:
+        from dolmen.xapian.journal import JournalQueue
+        queue.set_queue(JournalQueue(options.journal))
+    pipeline = retry = None
+    if options.processes:
+        from dolmen.xapian.pipeline import Pipeline
+        pipeline = Pipeline(options.processes)
+    if options.retries:
+        from dolmen.xapian.retry import RetryScheduler
+        retry = RetryScheduler(max_attempts=options.retries)
+
+    daemon = IndexerDaemon(connection, options.socket, options.spool,
+                           pipeline, retry)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.serve()
+    connection.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,33 +1,157 @@
 # -*- coding: utf-8 -*-
 
+import codecs
 import xappy
 import grokcore.component as grok
 
+from weakref import WeakKeyDictionary
 from zope import schema
 from zope.interface import providedBy
 from dolmen.xapian.interfaces import IIndexer, IIndexable
+from dolmen.xapian.metrics import metrics
 
 
 class DefaultContentIndexer(grok.Adapter):
     """This is the default implementation an IIndexer.
     It can be subclassed in order to be modified.
+
+    The fields to index are computed once per provided specification
+    and indexer class, and cached in `plans`. Subclasses setting
+    `partial` declare that they only read the attributes these fields
+    are named after, `indexed`: modifications of other attributes are
+    then ignored, and documents are rebuilt from the stored values of
+    the unchanged fields.
+
+    Field values can also be file-like objects or iterables of text
+    chunks, ie. for large bodies: they are read `chunk_size` characters
+    at a time, each chunk going to the document as a field of its own,
+    cut between words. Values longer than `max_field_size` characters
+    are truncated, when it is set.
     """
     grok.context(IIndexable)
     grok.provides(IIndexer)
 
-    def document(self, connection):
+    plans = WeakKeyDictionary()
+    # only reads the attributes returned by `indexed`
+    partial = False
+    # characters read at a time from file-like values
+    chunk_size = 65536
+    # characters indexed per field at most, None for no limit
+    max_field_size = None
+
+    def fields(self, spec):
+        """Returns the (name, query) pairs of the text fields provided
+        by the specification.
+        """
+        plan = []
+        for iface in spec:
+            for field in schema.getFields(iface).values():
+                if isinstance(field, (schema.Text, schema.ASCII)):
+                    plan.append((field.__name__, field.query))
+        return tuple(plan)
+
+    def plan(self):
+        spec = providedBy(self.context)
+        # subclasses may compute other fields
+        plans = self.plans.setdefault(spec, {})
+        cached = plans.get(self.__class__)
+        # a specification gets a new resolution order when it changes
+        if cached is None or cached[0] is not spec.__iro__:
+            cached = plans[self.__class__] = (
+                spec.__iro__, self.fields(spec))
+        return cached[1]
+
+    def indexed(self):
+        return frozenset(name for name, query in self.plan())
+
+    def document(self, connection, attributes=None, stored=None):
         """Returns a xapian index document from the context.
         Introspecting the connection provides the relevant fields available.
+
+        Given the changed `attributes` and the `stored` fields of the
+        indexed document, the values of the other fields are reused.
         """
         doc = xappy.UnprocessedDocument()
-        for iface in providedBy(self.context):
-            for field in schema.getFields(iface).values():
-                if not isinstance(field, (schema.Text, schema.ASCII)):
+        append = doc.fields.append
+        context = self.context
+        for name, query in self.plan():
+            if stored is not None and name not in attributes:
+                values = stored.get(name)
+                if values:
+                    for value in values:
+                        append(xappy.Field(name, value))
+                    continue
+            value = query(context)
+            if value is None:
+                value = u''
+            elif not isinstance(value, basestring):
+                if hasattr(value, 'read') or hasattr(value, '__iter__'):
+                    for chunk in self.chunks(value):
+                        append(xappy.Field(name, chunk))
                     continue
-                value = field.query(self.context)
-                if value is None:
-                    value = u''
-                if not isinstance(value, (str, unicode)):
-                    value = unicode(value)
-                doc.fields.append(xappy.Field(field.__name__, value))
+                value = unicode(value)
+            if (self.max_field_size is not None and
+                    len(value) > self.max_field_size):
+                value = truncate(value, self.max_field_size)
+            append(xappy.Field(name, value))
         return doc
+
+    def chunks(self, source):
+        """Yields the text of a file-like or iterable source in chunks
+        ending between words, up to `max_field_size` characters.
+        """
+        if hasattr(source, 'read'):
+            read = source.read
+            size = self.chunk_size
+            parts = iter(lambda: read(size), '')
+        else:
+            parts = iter(source)
+        decode = codecs.getincrementaldecoder('utf-8')('replace').decode
+        remaining = self.max_field_size
+        pending = u''
+        truncated = False
+        try:
+            for part in parts:
+                if not part:
+                    continue
+                if isinstance(part, str):
+                    part = decode(part)
+                text = pending + part
+                if remaining is not None and len(text) >= remaining:
+                    # the source may go on
+                    pending, truncated = text, True
+                    break
+                # keep the word cut by the end of the part for the next
+                cut = max(text.rfind(u' '), text.rfind(u'\n'))
+                if cut <= 0 and len(text) < self.chunk_size:
+                    pending = text
+                    continue
+                if cut <= 0:
+                    # no word boundary
+                    cut = len(text)
+                pending = text[cut:]
+                if cut:
+                    if remaining is not None:
+                        remaining -= cut
+                    yield text[:cut]
+            else:
+                pending += decode('', True)
+        finally:
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+        if truncated:
+            pending = truncate(pending, remaining)
+        if pending:
+            yield pending
+
+
+def truncate(text, size):
+    """Cuts the text at `size` characters, between words if possible.
+    """
+    metrics.increment('index.truncated')
+    text = text[:size + 1]
+    cut = max(text.rfind(u' '), text.rfind(u'\n'))
+    if cut > 0:
+        return text[:cut]
+    return text[:size]
@@ -25,6 +25,10 @@ OP_ADDED = 'added'
 OP_DELETED = 'deleted'
 OP_MODIFED = 'modified'
 
+# index queue lanes, see queue.IndexQueue
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+
 # occassionally on low index timeouts its possible that object
 # is added that hasn't yet been committed, so we get an unresolved
 # error. allow for retrying operations which can't resolve a context
@@ -60,6 +64,18 @@ class IIndexer( interface.Interface ):
         """Indexes an object into the connection
         """
 
+    partial = interface.Attribute(
+        u"Optional: True when `indexed` returns all the attributes the "
+        u"indexer reads, and `document` takes the changed `attributes` "
+        u"and the `stored` fields of the document to reuse the values "
+        u"of the unchanged ones. False by default.")
+
+    def indexed():
+        """Optional: returns the names of the attributes the indexer
+        reads, for indexers which are `partial`. Modifications of other
+        attributes are not queued.
+        """
+
 
 class IIndexOperation(interface.Interface):
 
@@ -68,7 +84,19 @@ class IIndexOperation(interface.Interface):
     
     resolver_id = schema.ASCIILine(
         description=u"The resolver used to find the content")
+
+    attributes = interface.Attribute(
+        u"The names of the changed attributes, None if unknown")
     
+    def prepare( connection ):
+        """Returns the payload (usually a document) to be written by
+        `apply`. Operations without payload return None.
+        """
+
+    def apply( connection, payload ):
+        """Writes a payload returned by `prepare` to the connection
+        """
+
     def process( connection ):
         """Processes an index operation
         """
@@ -88,9 +116,10 @@ class IOperationFactory( interface.Interface ):
         create an add operation
         """
 
-    def modify( ):
+    def modify( descriptions=() ):
         """
-        create a modify operation
+        create a modify operation, unless the modification descriptions
+        of the event show that no indexed attribute changed
         """
 
     def delete( ):
@@ -98,6 +127,12 @@ class IOperationFactory( interface.Interface ):
         create a delete operation
         """
 
+    def create( kind ):
+        """
+        return an operation of the given kind, without storing it, for
+        bulk queueing
+        """
+
 class IResolver( interface.Interface ):
     """
     provides for getting an object identity and resolving an object by
@@ -119,6 +154,30 @@ class IResolver( interface.Interface ):
         return the object represented by a document id
         """
 
+class IBulkResolver( IResolver ):
+    """
+    a resolver able to resolve many document ids at once. resolvers
+    don't need to declare it, providing `resolve_many` is enough.
+    """
+
+    def resolve_many( document_ids ):
+        """
+        return a mapping of the document ids to the objects they
+        represent, missing ids can be left out
+        """
+
+class IEnumerableResolver( IResolver ):
+    """
+    a resolver able to list the ids of all its content, used to
+    rebuild an index from scratch. as for bulk resolution, providing
+    `ids` is enough.
+    """
+
+    def ids( ):
+        """
+        return an iterable of all the document ids, in a stable order
+        """
+
 class IIndexConnection( interface.Interface ):
     """
     a xapian index connection
@@ -139,5 +198,22 @@ class IIndexSearch( interface.Interface ):
 
     def __call__( ):
         """
-        return a search connection
+        return the search connection of the calling thread, one per
+        thread
+        """
+
+class IIndexMetrics( interface.Interface ):
+    """
+    live measures of the indexing pipeline: counters, sampled timings,
+    flush sizes and gauges computed when queried.
+    """
+
+    def snapshot( ):
+        """
+        return a mapping of the current measures
+        """
+
+    def subscribe( hook ):
+        """
+        call hook(name, value) with each timing sample and flush
         """
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""On-disk journal of the index queue.
+
+Queued operations are appended to log segments in a journal directory,
+and the queue processor checkpoints the journal once operations are
+flushed to the index. When the process restarts, operations past the
+last checkpoint are replayed into the queue. Segments holding only
+checkpointed operations are removed.
+
+Operations are numbered when queued, but one held back by an overflow
+policy is journaled when it enters the queue: numbers are not always
+increasing along the journal, segments record the highest they hold.
+
+Queueing only hands the operations to the OS. The indexer thread
+syncs the journal to disk, outside of the queue lock, before waiting
+for operations and every `SYNC_COUNT` operations or `SYNC_INTERVAL`
+seconds: the committing threads don't wait for the disk.
+
+To use it, replace the default queue before starting the processor:
+
+  queue.set_queue(journal.JournalQueue('/var/lib/app/index-journal'))
+"""
+
+import os
+import time
+import logging
+import json
+
+from dolmen.xapian import operation
+from dolmen.xapian.queue import IndexQueue
+
+log = logging.getLogger('dolmen.xapian')
+
+
+def sync_files(descriptors):
+    """Syncs then closes file descriptors.
+    """
+    for descriptor in descriptors:
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+class Journal(object):
+    """Append-only operation log, split in segments.
+    """
+
+    # Start a new segment every _n_ operations
+    SEGMENT_SIZE = 10000
+
+    # Sync to disk every _n_ operations
+    SYNC_COUNT = 100
+
+    # Sync to disk at most _n_ seconds after the last sync
+    SYNC_INTERVAL = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.position = self._read_checkpoint()
+        self.segments = self._list_segments()
+        self.last = self.position
+        self.file = None
+        self.count = 0
+        self.unsynced = 0
+        self.synced = time.time()
+        # descriptors of rotated segments, not synced yet
+        self.rotated = []
+
+    def _read_checkpoint(self):
+        try:
+            fh = open(os.path.join(self.path, 'checkpoint'))
+        except IOError:
+            return 0
+        try:
+            return int(fh.read().strip() or 0)
+        finally:
+            fh.close()
+
+    def _list_segments(self):
+        """Returns the [number, name, highest operation] of the segments,
+        the highest operations are known once replayed.
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            if name.startswith('segment-') and name.endswith('.log'):
+                segments.append([int(name[8:-4]), name, None])
+        segments.sort()
+        return segments
+
+    def _read(self, name):
+        fh = open(os.path.join(self.path, name))
+        try:
+            for line in fh:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # torn write at the end of a segment
+                    log.warn("Journal: skipping damaged entry in %s" % name)
+                    return
+        finally:
+            fh.close()
+
+    def replay(self):
+        """Yields the operations queued after the last checkpoint.
+        """
+        for segment in self.segments:
+            segment[2] = 0
+            for seq, kind, oid, resolver_id in self._read(segment[1]):
+                segment[2] = max(segment[2], seq)
+                self.last = max(self.last, seq)
+                if seq <= self.position:
+                    continue
+                op = operation.restore(kind, oid, resolver_id)
+                op.seq = seq
+                yield op
+
+    def _rotate(self):
+        if self.file is not None:
+            if self.unsynced:
+                # synced along with the next segment
+                self.rotated.append(os.dup(self.file.fileno()))
+            self.file.close()
+            self.file = None
+        number = self.segments and self.segments[-1][0] + 1 or 1
+        name = 'segment-%020d.log' % number
+        self.file = open(os.path.join(self.path, name), 'a')
+        self.segments.append([number, name, 0])
+        self.count = 0
+
+    def append(self, op):
+        if self.file is None or self.count >= self.SEGMENT_SIZE:
+            self._rotate()
+        self.file.write(json.dumps(
+            [op.seq, op.kind, op.oid, op.resolver_id]) + '\n')
+        # hand it to the os right away, disk syncs are batched
+        self.file.flush()
+        segment = self.segments[-1]
+        segment[2] = max(segment[2], op.seq)
+        self.last = max(self.last, op.seq)
+        self.count += 1
+        self.unsynced += 1
+
+    def due(self):
+        """Tells if the journal is to be synced.
+        """
+        return self.unsynced and (
+            self.unsynced >= self.SYNC_COUNT or
+            time.time() - self.synced >= self.SYNC_INTERVAL)
+
+    def unsynced_files(self):
+        """Returns descriptors of the segments written since the last
+        sync, to be synced then closed by the caller, which doesn't
+        need to keep the journal locked meanwhile.
+        """
+        descriptors, self.rotated = self.rotated, []
+        if self.file is not None and self.unsynced:
+            descriptors.append(os.dup(self.file.fileno()))
+        self.unsynced = 0
+        self.synced = time.time()
+        return descriptors
+
+    def sync(self):
+        sync_files(self.unsynced_files())
+
+    def checkpoint(self, position):
+        """Records that operations up to `position` are in the index.
+        """
+        if position <= self.position:
+            return
+        filename = os.path.join(self.path, 'checkpoint')
+        fh = open(filename + '.tmp', 'w')
+        try:
+            fh.write('%d\n' % position)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        os.rename(filename + '.tmp', filename)
+        self.position = position
+        self.compact()
+
+    def compact(self):
+        """Removes the segments holding only checkpointed operations.
+        """
+        while len(self.segments) > 1 and \
+              self.segments[0][2] is not None and \
+              self.segments[0][2] <= self.position:
+            number, name, highest = self.segments.pop(0)
+            os.remove(os.path.join(self.path, name))
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class JournalQueue(IndexQueue):
+    """An index queue journaling its operations on disk, replaying the
+    ones not yet checkpointed when created.
+    """
+
+    def __init__(self, path, maxsize=0, coalesce=False, overflow=None,
+                 lanes=None):
+        self.journal = Journal(path)
+        IndexQueue.__init__(self, maxsize, coalesce, overflow, lanes)
+        replayed = 0
+        for op in self.journal.replay():
+            IndexQueue._put(self, op)
+            replayed += 1
+        self.sequence = self.journal.last
+        self.position = self.journal.position
+        if replayed:
+            log.info("Journal: replayed %s operations from %s" %
+                     (replayed, path))
+
+    def _put(self, op):
+        if op.seq is None:
+            self._number(op)
+        self.journal.append(op)
+        IndexQueue._put(self, op)
+
+    def get(self, block=True, timeout=None):
+        # the indexer is about to wait, don't leave anything unsynced
+        if block or self.journal.due():
+            self.sync()
+        return IndexQueue.get(self, block, timeout)
+
+    def sync(self):
+        self.mutex.acquire()
+        try:
+            descriptors = self.journal.unsynced_files()
+        finally:
+            self.mutex.release()
+        # operations are queued meanwhile
+        sync_files(descriptors)
+
+    def _checkpoint(self, position):
+        self.journal.checkpoint(position)
+
+    def close(self):
+        self.mutex.acquire()
+        try:
+            self.journal.close()
+        finally:
+            self.mutex.release()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Keeping an index in shape.
+
+Replacing and deleting documents leaves the index tables fragmented
+over time. A queue processor given a `Maintenance` compacts the index
+into a new database now and then, during a low traffic window, and
+swaps it in place of the current one:
+
+  maintenance = Maintenance(interval=7 * 86400, window=(2, 5))
+  queue.QueueProcessor.start(connection, maintenance=maintenance)
+
+Compaction runs in the indexer thread, between two batches, once the
+pending changes are flushed: operations queued meanwhile wait in the
+index queue, and are written to the new database. The processor then
+writes through a new connection, the one it was started with is
+closed. The index path must be a symbolic link to the database
+directory, which is swapped atomically (see `reindex.swap`): the index
+is not compacted otherwise. The search connections notice the swap
+through the index generation.
+
+Search connections are cold once reopened. A `ConnectionHub` given
+`warmup` queries runs them on the connections it opens or reopens, and
+a `Warmer` thread reopens the idle pooled connections as soon as the
+index changed, so request threads are handed warm connections:
+
+  search = IndexSearch(index_path, warmup=[u'news', u'events'])
+  Warmer(search.hub).start()
+"""
+
+import os
+import time
+import shutil
+import logging
+import threading
+import xapian
+import xappy
+
+from dolmen.xapian.metrics import metrics
+from dolmen.xapian.reindex import swap
+
+log = logging.getLogger('dolmen.xapian')
+
+
+def compact(source, destination):
+    """Writes a compacted copy of the index at `source`, with the files
+    which are not xapian tables, ie. the index generation.
+    """
+    database = xapian.Database(source)
+    try:
+        if hasattr(database, 'compact'):
+            database.compact(destination)
+        else:
+            compactor = xapian.Compactor()
+            compactor.set_destdir(destination)
+            compactor.add_source(source)
+            compactor.compact()
+    finally:
+        database.close()
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        if (name.endswith('lock') or not os.path.isfile(path) or
+                os.path.exists(os.path.join(destination, name))):
+            continue
+        shutil.copy2(path, os.path.join(destination, name))
+
+
+class Maintenance(object):
+    """Compacts the index of a queue processor at most every `interval`
+    seconds, within the `window` of local hours when given, ie. (2, 5)
+    from 2am to 5am.
+    """
+
+    def __init__(self, interval=86400, window=None, keep_previous=False):
+        self.interval = interval
+        self.window = window
+        # keep the index swapped out, instead of removing it
+        self.keep_previous = keep_previous
+        # the first compaction waits for an interval too
+        self.last = time.time()
+        self.compactions = 0
+
+    def in_window(self, now):
+        if self.window is None:
+            return True
+        start, end = self.window
+        hour = time.localtime(now).tm_hour
+        if start <= end:
+            return start <= hour < end
+        # ie. (22, 4), over midnight
+        return hour >= start or hour < end
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.last >= self.interval and self.in_window(now)
+
+    def open(self, index_path):
+        return xappy.IndexerConnection(index_path)
+
+    def run(self, processor):
+        """Compacts the index of the processor and swaps it in. Called
+        by the indexer thread.
+        """
+        self.last = time.time()
+        index_path = processor.index_path
+        if index_path is None:
+            log.error("Maintenance: no index path, can't compact")
+            return
+        if not os.path.islink(index_path):
+            # renaming directories would leave no index for a moment
+            log.error("Maintenance: %s is not a symbolic link, can't swap "
+                      "a compacted index atomically" % index_path)
+            return
+        if processor.pending_ops:
+            processor.flush()
+
+        source = os.path.realpath(index_path)
+        number = int(self.last)
+        while True:
+            compacted = '%s.%d' % (index_path.rstrip(os.sep), number)
+            # not the current database
+            if not os.path.exists(compacted):
+                break
+            number += 1
+        try:
+            compact(source, compacted)
+        except Exception:
+            log.exception("Maintenance: compaction of %s failed" %
+                          index_path)
+            if os.path.exists(compacted):
+                shutil.rmtree(compacted)
+            return
+
+        processor.connection.close()
+        try:
+            previous = swap(index_path, compacted)
+        except Exception:
+            log.exception("Maintenance: swapping %s failed" % index_path)
+            # the link was not changed, don't create an index in its place
+            current = os.path.realpath(index_path)
+            processor.connection = self.open(current)
+            if current != os.path.realpath(compacted):
+                shutil.rmtree(compacted, True)
+            return
+        processor.connection = self.open(index_path)
+        if not self.keep_previous:
+            shutil.rmtree(previous, True)
+        self.compactions += 1
+        metrics.timing('compaction', time.time() - self.last)
+        log.info("Maintenance: compacted %s in %.1fs" %
+                 (index_path, time.time() - self.last))
+
+    def status(self):
+        return dict(compactions=self.compactions, last=self.last,
+                    interval=self.interval, window=self.window)
+
+
+class Warmer(threading.Thread):
+    """Reopens and warms up the idle connections of a hub once the
+    index changed, checking every `interval` seconds.
+    """
+
+    def __init__(self, hub, interval=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.hub = hub
+        if interval is None:
+            interval = hub.auto_refresh_delta
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            try:
+                self.hub.refresh()
+            except Exception:
+                log.exception("Warmer: refresh failed")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Runtime measures of the indexing pipeline.
+
+The `metrics` instance, registered as the `IIndexMetrics` utility,
+counts processed operations per kind, failed operations per kind and
+per stage (prepare or write) and search connection reopens, keeps
+flush sizes, and times resolving, document building, index writes and
+flushes. Per operation timings are only taken for one operation out of
+`sample_every`, to be cheap enough to leave on.
+
+Gauges are callables computing a value when a snapshot is taken, like
+the depth of the index queue and the age of its oldest operation.
+
+Operations prepared by pipeline worker processes are timed in those
+processes, and don't show up here.
+"""
+
+import time
+import itertools
+import logging
+import grokcore.component as grok
+
+from zope import interface
+from dolmen.xapian.interfaces import IIndexMetrics
+
+log = logging.getLogger('dolmen.xapian')
+
+
+class Timer(object):
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def stats(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    mean=self.count and self.total / self.count or 0.0)
+
+
+class Metrics(object):
+    interface.implements(IIndexMetrics)
+
+    # time one operation out of _n_
+    sample_every = 10
+
+    enabled = True
+
+    def __init__(self):
+        self.hooks = []
+        self.gauges = {}
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+        self.samples = itertools.count()
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.flushed_bytes = 0
+        self.last_flush = None
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def sampling(self):
+        """Tells if the current operation is to be timed.
+        """
+        return self.enabled and self.samples.next() % self.sample_every == 0
+
+    def timing(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        timer.add(seconds)
+        self.notify(name, seconds)
+
+    def flushed(self, ops, bytes, seconds):
+        if not self.enabled:
+            return
+        self.flushes += 1
+        self.flushed_ops += ops
+        self.flushed_bytes += bytes
+        self.last_flush = dict(
+            operations=ops, bytes=bytes, seconds=seconds, time=time.time())
+        self.timing('flush', seconds)
+        self.notify('flush.size', ops)
+
+    def gauge(self, name, compute):
+        self.gauges[name] = compute
+
+    def subscribe(self, hook):
+        self.hooks.append(hook)
+
+    def notify(self, name, value):
+        for hook in self.hooks:
+            try:
+                hook(name, value)
+            except:
+                log.exception("Error in metrics hook %r" % hook)
+
+    def snapshot(self):
+        gauges = {}
+        for name, compute in self.gauges.items():
+            try:
+                gauges[name] = compute()
+            except:
+                log.exception("Error computing gauge %s" % name)
+                gauges[name] = None
+        return dict(
+            counters=dict(self.counters),
+            timers=dict((name, timer.stats())
+                        for name, timer in self.timers.items()),
+            flushes=dict(count=self.flushes, operations=self.flushed_ops,
+                         bytes=self.flushed_bytes, last=self.last_flush),
+            gauges=gauges)
+
+
+metrics = Metrics()
+grok.global_utility(metrics, provides=IIndexMetrics, direct=True)
@@ -7,43 +7,105 @@ import interfaces
 import queue
 import logging
 
+from contextlib import contextmanager
+from time import time
 from zope import interface
 import grokcore.component as grok
-from dolmen.xapian.interfaces import (
-    IIndexOperation, IResolver, IAddOperation)
-from zope.component import getUtility
+from dolmen.xapian.interfaces import IIndexOperation, IAddOperation
+from dolmen.xapian.metrics import metrics
+from dolmen.xapian.results import get_resolver
+from dolmen.xapian.search import bump_generation
 
 
 log = logging.getLogger('dolmen.xapian')
 
 
+class Unresolved(LookupError):
+    """The content of an operation could not be resolved.
+    """
+
+
 class IndexOperation(object):
     """An async/queued index operation
     """
     interface.implements(IIndexOperation)
 
-    __slots__ = ('oid', 'resolver_id', 'requeue')
+    __slots__ = ('oid', 'resolver_id', 'requeue', 'seq', 'queued',
+                 'attributes', 'lane')
     requeue = False
+    kind = None
+    # precedence when aggregating, see `choose` and `combine`
+    rank = None
 
-    def __init__(self, oid, resolver_id):
+    def __init__(self, oid, resolver_id, attributes=None):
         self.oid = oid
         self.resolver_id = resolver_id
+        # names of the changed attributes, None for all
+        self.attributes = attributes
+        # index queue lane, None for the default one
+        self.lane = None
+        # position in the index queue, assigned when queued
+        self.seq = None
+        # when it was queued
+        self.queued = None
 
     def resolve(self):
-        if self.resolver_id:
-            resolver = getUtility(IResolver, self.resolver_id)
-        else:
-            resolver = getUtility(IResolver)
-        instance = resolver.resolve(self.oid)
+        instance = get_resolver(self.resolver_id).resolve(self.oid)
 
         if not instance:
-            log.error("Idx Operation - Could Not Resolve %s" % self.oid)
-            return
+            # ie. added by a transaction the indexer doesn't see yet
+            raise Unresolved("Idx Operation - Could Not Resolve %s" %
+                             self.oid)
 
         return instance
 
+    def prepare(self, connection):
+        """Returns the payload to write to the index, if any.
+        """
+        return None
+
+    def apply(self, connection, payload):
+        """Writes a prepared payload to the index.
+        """
+        raise NotImplementedError
+
     def process(self, connection):
-        raise NotImplemented
+        return self.apply(connection, self.prepare(connection))
+
+    def document(self, connection):
+        """Resolves the content and builds its document, timing both
+        steps when sampled.
+        """
+        if not metrics.sampling():
+            doc = self.build(self.resolve(), connection)
+        else:
+            started = time()
+            instance = self.resolve()
+            resolved = time()
+            doc = self.build(instance, connection)
+            metrics.timing('resolve', resolved - started)
+            metrics.timing('document', time() - resolved)
+        doc.id = self.document_id
+        doc.fields.append(xappy.Field('resolver', self.resolver_id or ''))
+        return doc
+
+    def build(self, instance, connection):
+        indexer = interfaces.IIndexer(instance)
+        if self.attributes is None or not partial(indexer):
+            return indexer.document(connection)
+        return indexer.document(connection, self.attributes,
+                                self.stored(connection))
+
+    def stored(self, connection):
+        """Returns the stored fields of the indexed document, if any.
+        """
+        if connection is None:
+            # ie. in a pipeline worker
+            return None
+        try:
+            return connection.get_document(self.document_id).data
+        except KeyError:
+            return None
 
     @property
     def document_id(self):
@@ -53,42 +115,157 @@ class IndexOperation(object):
 class AddOperation(IndexOperation):
 
     interface.implements(IAddOperation)
+    kind = interfaces.OP_ADDED
+    rank = 1
 
-    def process(self, connection):
+    def prepare(self, connection):
+        return self.document(connection)
+
+    def apply(self, connection, doc):
         if interfaces.DEBUG_LOG:
             log.info("Adding %r" % self.document_id)
-        instance = self.resolve()
-        doc = interfaces.IIndexer(instance).document(connection)
-        doc.id = self.document_id
-        doc.fields.append(xappy.Field('resolver', self.resolver_id or ''))
         connection.add(doc)
 
 
 class ModifyOperation(IndexOperation):
 
     interface.implements(interfaces.IModifyOperation)
+    kind = interfaces.OP_MODIFED
+    rank = 0
 
-    def process(self, connection):
-        instance = self.resolve()
-        doc = interfaces.IIndexer(instance).document(connection)
-        doc.id = self.document_id
-        doc.fields.append(xappy.Field('resolver', self.resolver_id))
+    def prepare(self, connection):
+        return self.document(connection)
+
+    def apply(self, connection, doc):
         connection.replace(doc)
 
 
 class DeleteOperation(IndexOperation):
 
     interface.implements(interfaces.IDeleteOperation)
+    kind = interfaces.OP_DELETED
+    rank = 2
 
-    def process(self, connection):
+    def apply(self, connection, payload):
         connection.delete(self.document_id)
 
 
+OPERATIONS = dict((op.kind, op) for op in (
+    AddOperation, ModifyOperation, DeleteOperation))
+
+
+def choose(previous, new):
+    """For a given content object, choose one operation to perform given
+    two candidates. can also return no operations.
+    """
+    p_kind = previous.rank
+    if p_kind is None:
+        p_kind = rank_of(previous)
+    n_kind = new.rank
+    if n_kind is None:
+        n_kind = rank_of(new)
+
+    # if we have an add and then a delete, its an effective no-op
+    if (p_kind == 1 and n_kind == 2):
+        return None
+    if p_kind == 0 and n_kind == 0:
+        new.attributes = merge_attributes(previous.attributes, new.attributes)
+    if p_kind > n_kind:
+        return previous
+    return new
+
+
+def combine(previous, new):
+    """Coalesces the operations of a document queued by two successive
+    transactions into one. Unlike within a transaction, the new one is
+    applied last: a document deleted then added again is written.
+    """
+    p_kind = previous.rank
+    if p_kind is None:
+        p_kind = rank_of(previous)
+    n_kind = new.rank
+    if n_kind is None:
+        n_kind = rank_of(new)
+
+    if n_kind == 2:
+        return new
+    if n_kind == 1:
+        if p_kind == 1:
+            return new
+        # the document may be in the index already
+        return replace(new)
+    if p_kind == 1:
+        # the add builds the whole document when applied
+        return previous
+    if p_kind == 0:
+        new.attributes = merge_attributes(previous.attributes, new.attributes)
+    else:
+        new.attributes = None
+    return new
+
+
+def replace(op):
+    """Returns a modification rebuilding the whole document, in place
+    of the operation.
+    """
+    modify = ModifyOperation(op.oid, op.resolver_id)
+    modify.seq = op.seq
+    modify.queued = op.queued
+    modify.lane = op.lane
+    modify.requeue = op.requeue
+    return modify
+
+
+def rank_of(op):
+    """Ranks operations not derived from the ones of this module.
+    """
+    return (interfaces.IDeleteOperation.providedBy(op) and 2) \
+           or (interfaces.IAddOperation.providedBy(op) and 1) \
+           or (interfaces.IModifyOperation.providedBy(op) and 0)
+
+
+def merge_attributes(previous, new):
+    if previous is None or new is None:
+        return None
+    return previous | new
+
+
+def changed_attributes(descriptions):
+    """Returns the names of the attributes described as changed by a
+    modification event, None if they are not all known.
+    """
+    names = set()
+    for description in descriptions:
+        attributes = getattr(description, 'attributes', None)
+        if attributes is None:
+            return None
+        names.update(attributes)
+    if not names:
+        return None
+    return frozenset(names)
+
+
+def partial(indexer):
+    """Tells if the indexer declared all the attributes it reads, and
+    can reuse the stored values of the unchanged ones.
+    """
+    return (getattr(indexer, 'partial', False) and
+            getattr(indexer, 'indexed', None) is not None)
+
+
+def restore(kind, oid, resolver_id):
+    """Rebuilds an operation from its kind and identifiers.
+    """
+    return OPERATIONS[kind](oid, resolver_id)
+
+
 class OperationBufferManager(object):
     """
     ideally we'd be doing this via the synchronizer api, but that has several
     issues, which i need to work on in the transaction package, for now the
     standard transaction manager api suffices.
+
+    A buffer keeps its manager, joining it to each transaction.
     """
 
     def __init__(self, buffer):
@@ -117,6 +294,9 @@ class OperationBuffer(object):
     def __init__(self):
         self.ops = {}
         self.registered = False
+        self.manager = OperationBufferManager(self)
+        # what to wait for to see the last flushed operations indexed
+        self.token = None
 
     def add(self, op):
         """add an operation to the buffer, aggregating
@@ -133,38 +313,23 @@ class OperationBuffer(object):
     def clear(self):
         self.ops = {}
         self.registered = False
-        self.manager = None
 
     def flush(self):
-        for op in self.ops.values():
-            queue.index_queue.put(op)
+        index_queue = queue.index_queue
+        ops = self.ops.values()
+        # numbers the operations
+        index_queue.put_many(ops)
+        if ops:
+            self.token = (index_queue, index_queue.mark(ops))
         self.ops = {}
         self.registered = False
-        self.manager = None
 
     def _register(self):
-        self.manager = OperationBufferManager(self)
         self.registered = True
         transaction.get().join(self.manager)
 
     def _choose(self, previous, new):
-        """For a given content object, choose one operation to perform given
-        two candidates. can also return no operations.
-        """
-        p_kind = (interfaces.IDeleteOperation.providedBy(previous) and 2) \
-                 or (interfaces.IAddOperation.providedBy(previous) and 1) \
-                 or (interfaces.IModifyOperation.providedBy(previous) and 0)
-
-        n_kind = (interfaces.IDeleteOperation.providedBy(new) and 2) \
-                 or (interfaces.IAddOperation.providedBy(new) and 1) \
-                 or (interfaces.IModifyOperation.providedBy(new) and 0)
-
-        # if we have an add and then a delete, its an effective no-op
-        if (p_kind == 1 and n_kind == 2):
-            return None
-        if p_kind > n_kind:
-            return previous
-        return new
+        return choose(previous, new)
 
 
 _buffer = threading.local()
@@ -179,42 +344,156 @@ def get_buffer():
     return op_buffer
 
 
+def wait_for_indexed(timeout=None, token=None):
+    """Waits until the operations of the last transaction committed
+    by this thread are indexed and searchable, for at most `timeout`
+    seconds. Returns False if they are not.
+
+    Other threads can wait for them with the `token` of the buffer:
+
+      token = get_buffer().token
+    """
+    if token is None:
+        token = get_buffer().token
+        if token is None:
+            return True
+    index_queue, mark = token
+    return index_queue.wait(mark, timeout)
+
+
+_lane = threading.local()
+
+
+def current_lane():
+    return getattr(_lane, 'name', None)
+
+
+@contextmanager
+def lane(name):
+    """Puts the operations created in the block in an index queue
+    lane, ie. around the transactions of a bulk import:
+
+      with lane(interfaces.LANE_BULK):
+          ...
+          transaction.commit()
+    """
+    previous = current_lane()
+    _lane.name = name
+    try:
+        yield
+    finally:
+        _lane.name = previous
+
+
 class OperationFactory(grok.Adapter):
     grok.context(interfaces.IIndexable)
     grok.provides(interfaces.IOperationFactory)
 
     __slots__ = ('context',)
     resolver_id = ''  # default resolver
+    lane = None  # index queue lane, defaults to the current one
 
     def add(self):
         return self._store(AddOperation(*self._id()))
 
-    def modify(self):
-        return self._store(ModifyOperation(*self._id()))
+    def modify(self, descriptions=()):
+        attributes = changed_attributes(descriptions)
+        if attributes is not None:
+            indexer = interfaces.IIndexer(self.context)
+            if not partial(indexer):
+                # can't tell which attributes matter
+                attributes = None
+            else:
+                attributes = attributes & indexer.indexed()
+                if not attributes:
+                    return
+        return self._store(ModifyOperation(*self._id(),
+                                           attributes=attributes))
 
     def remove(self):
         return self._store(DeleteOperation(*self._id()))
 
-    def _store(self, op):
-        """Optionally enable synchronous operation,
-        which bypasses the queue, for testing purposes.
+    def create(self, kind):
+        """Returns an operation of the given kind on the context, not
+        stored, see `queue_many`.
         """
-        if interfaces.DEBUG_SYNC and interfaces.DEBUG_SYNC_IDX:
-            if interfaces.DEBUG_LOG:
-                log.info("Processing %r %r" % (op.oid, op))
-            op.process(interfaces.DEBUG_SYNC_IDX)
-            interfaces.DEBUG_SYNC_IDX.flush()
-            if interfaces.DEBUG_LOG:
-                log.info("Flushed Index")
-        else:
-            get_buffer().add(op)
+        op = OPERATIONS[kind](*self._id())
+        op.lane = self.lane or current_lane()
+        return op
+
+    def _store(self, op):
+        if op.lane is None:
+            op.lane = self.lane or current_lane()
+        store(op)
 
     def _id(self):
-        if self.resolver_id:
-            resolver = getUtility(IResolver, self.resolver_id)
-        else:
-            resolver = getUtility(IResolver)
-        oid = resolver.id(self.context)
+        oid = get_resolver(self.resolver_id).id(self.context)
         if not oid:
             raise KeyError("Key Not Found %r" % self.context)
         return oid, self.resolver_id
+
+
+def store(op):
+    """Buffers an operation in the current transaction. Optionally
+    enable synchronous operation, which bypasses the queue, for testing
+    purposes.
+    """
+    if interfaces.DEBUG_SYNC and interfaces.DEBUG_SYNC_IDX:
+        if interfaces.DEBUG_LOG:
+            log.info("Processing %r %r" % (op.oid, op))
+        op.process(interfaces.DEBUG_SYNC_IDX)
+        interfaces.DEBUG_SYNC_IDX.flush()
+        index_path = getattr(interfaces.DEBUG_SYNC_IDX, '_indexpath', None)
+        if index_path is not None:
+            # search connections are reopened when it changes
+            bump_generation(index_path)
+        if interfaces.DEBUG_LOG:
+            log.info("Flushed Index")
+    else:
+        get_buffer().add(op)
+
+
+def queue_many(items, kind=interfaces.OP_ADDED, direct=False,
+               chunk_size=1000, lane=None):
+    """Creates operations of a kind for many objects at once, without
+    going through object events, ie. for imports. Items are objects,
+    adapted to `IOperationFactory`, or (oid, resolver_id) pairs, and
+    can be given by a generator:
+
+      queue_many(((oid, 'rdb') for oid in ids), interfaces.OP_ADDED,
+                 direct=True)
+
+    The operations go to the buffer of the transaction, or with
+    `direct` straight to the index queue, `chunk_size` at a time: only
+    a chunk is held in memory then, and the objects must be committed
+    already. Either way, `wait_for_indexed` waits for them. Returns the
+    number of operations.
+    """
+    lane = lane or current_lane()
+    count = 0
+    chunk = []
+    for item in items:
+        if isinstance(item, tuple):
+            op = OPERATIONS[kind](*item)
+            op.lane = lane
+        else:
+            op = interfaces.IOperationFactory(item).create(kind)
+            if lane is not None:
+                op.lane = lane
+        count += 1
+        if not direct:
+            store(op)
+            continue
+        chunk.append(op)
+        if len(chunk) >= chunk_size:
+            _queue_chunk(chunk)
+            chunk = []
+    if chunk:
+        _queue_chunk(chunk)
+    return count
+
+
+def _queue_chunk(ops):
+    index_queue = queue.index_queue
+    index_queue.put_many(ops)
+    get_buffer().token = (index_queue, index_queue.mark(ops))
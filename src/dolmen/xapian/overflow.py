@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""What a bounded index queue does when it is full.
+
+Operations are queued by `OperationBuffer.flush` once a transaction is
+committed: the committing thread must not wait for the indexer for
+long. An index queue created with a `maxsize` and an overflow policy
+hands the operations it has no room for to the policy:
+
+  queue.set_queue(queue.IndexQueue(
+      maxsize=50000, overflow=overflow.Block(1.0, overflow.Spill(path))))
+
+ - `Block` waits for room up to a timeout per transaction, then hands
+   over to its fallback policy until the queue has room again. It is
+   the policy of queues given a `maxsize` only, dropping after a
+   second,
+
+ - `Spill` appends the operations to a file, they are queued back as
+   the indexer drains the queue,
+
+ - `Coalesce` merges the operation into one waiting for the same
+   document, for queues created with `coalesce=True`,
+
+ - `Drop` only remembers the documents, operations for them are queued
+   back once the queue is half empty.
+
+Operations held by a policy are released by the indexer thread when it
+takes operations from the queue. Later operations on a held document
+are held too, so that they are applied in order.
+"""
+
+import json
+import time
+import Queue
+import logging
+
+from threading import Lock, local
+from dolmen.xapian import operation
+
+log = logging.getLogger('dolmen.xapian')
+
+
+class OverflowPolicy(object):
+    """Takes the operations a full queue has no room for.
+    """
+    name = None
+
+    def holding(self, op):
+        """Tells if the operation must go through the policy, to stay
+        behind the ones it holds.
+        """
+        return False
+
+    def put(self, queue, op):
+        raise NotImplementedError
+
+    def begin(self):
+        """Called before the operations of a transaction are queued.
+        """
+
+    def end(self):
+        """Called once the operations of a transaction are queued.
+        """
+
+    def release(self, queue):
+        """Moves held operations back to the queue, as room allows.
+        Called by the indexer thread.
+        """
+
+    def status(self):
+        return dict(policy=self.name)
+
+
+def requeue(queue, op):
+    """Queues a released operation if there is room for it.
+    """
+    try:
+        Queue.Queue.put(queue, op, False)
+    except Queue.Full:
+        return False
+    return True
+
+
+class Drop(OverflowPolicy):
+    """Drops the operations, keeping the last operation of each
+    document to queue it once the queue is half empty.
+    """
+    name = 'drop'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.marked = {}
+        self.dropped = 0
+
+    def holding(self, op):
+        return op.document_id in self.marked
+
+    def put(self, queue, op):
+        self.lock.acquire()
+        try:
+            self.dropped += 1
+            key = op.document_id
+            previous = self.marked.get(key)
+            if previous is not None:
+                chosen = operation.combine(previous, op)
+                # indexed along with the one kept
+                for dropped in (previous, op):
+                    queue.absorb(chosen, dropped)
+                op = chosen
+            self.marked[key] = op
+        finally:
+            self.lock.release()
+
+    def release(self, queue):
+        if not self.marked or queue.qsize() * 2 > queue.maxsize:
+            return
+        self.lock.acquire()
+        try:
+            while self.marked:
+                key, op = self.marked.popitem()
+                if not requeue(queue, op):
+                    self.marked[key] = op
+                    break
+        finally:
+            self.lock.release()
+
+    def status(self):
+        return dict(policy=self.name, dropped=self.dropped,
+                    marked=len(self.marked))
+
+
+class Spill(OverflowPolicy):
+    """Appends the operations to a file. Once anything is spilled, all
+    operations go to the file until it is drained.
+
+    The file is kept on restart, its operations are then queued again
+    and numbered anew: ones released just before a crash may be applied
+    twice.
+    """
+    name = 'spill'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.writer = open(path, 'a')
+        self.reader = open(path, 'r')
+        self.pending = len(self.reader.readlines())
+        # operations spilled by a previous process
+        self.stale = self.pending
+        self.reader.seek(0)
+        self.spilled = 0
+
+    def holding(self, op):
+        return self.pending > 0
+
+    def put(self, queue, op):
+        self.lock.acquire()
+        try:
+            self.writer.write(json.dumps(
+                [op.seq, op.kind, op.oid, op.resolver_id]) + '\n')
+            self.writer.flush()
+            self.pending += 1
+            self.spilled += 1
+        finally:
+            self.lock.release()
+
+    def release(self, queue):
+        if not self.pending or queue.full():
+            return
+        self.lock.acquire()
+        try:
+            while self.pending:
+                position = self.reader.tell()
+                line = self.reader.readline()
+                if not line.endswith('\n'):
+                    # not fully written yet
+                    self.reader.seek(position)
+                    break
+                seq, kind, oid, resolver_id = json.loads(line)
+                op = operation.restore(kind, oid, resolver_id)
+                if self.stale:
+                    seq = None
+                op.seq = seq
+                if not requeue(queue, op):
+                    self.reader.seek(position)
+                    break
+                self.pending -= 1
+                if self.stale:
+                    self.stale -= 1
+            if not self.pending:
+                # all drained, start over
+                self.writer.truncate(0)
+                self.writer.seek(0)
+                self.reader.seek(0)
+        finally:
+            self.lock.release()
+
+    def status(self):
+        return dict(policy=self.name, spilled=self.spilled,
+                    pending=self.pending, path=self.path)
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+
+class Fallback(OverflowPolicy):
+    """Base for the policies handing some operations to another one.
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or Drop()
+
+    def holding(self, op):
+        return self.fallback.holding(op)
+
+    def begin(self):
+        self.fallback.begin()
+
+    def end(self):
+        self.fallback.end()
+
+    def release(self, queue):
+        self.fallback.release(queue)
+
+    def status(self):
+        status = dict(policy=self.name)
+        status['fallback'] = self.fallback.status()
+        return status
+
+
+class Block(Fallback):
+    """Waits up to `timeout` seconds for room in the queue, for all the
+    operations of a transaction together. After a timeout, operations
+    go to the fallback policy without waiting until the indexer makes
+    room.
+    """
+    name = 'block'
+
+    def __init__(self, timeout=1.0, fallback=None):
+        Fallback.__init__(self, fallback)
+        self.timeout = timeout
+        self.saturated = False
+        self.timeouts = 0
+        # deadline of the transaction being queued, by thread
+        self.local = local()
+
+    def begin(self):
+        self.local.deadline = time.time() + self.timeout
+        Fallback.begin(self)
+
+    def end(self):
+        self.local.deadline = None
+        Fallback.end(self)
+
+    def put(self, queue, op):
+        # behind the held operations of the document, if any
+        if not self.saturated and not self.fallback.holding(op):
+            deadline = getattr(self.local, 'deadline', None)
+            if deadline is None:
+                timeout = self.timeout
+            else:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                Queue.Queue.put(queue, op, True, timeout)
+                return
+            except Queue.Full:
+                self.saturated = True
+                self.timeouts += 1
+                log.warn("Index queue full for %ss, overflowing to %s" %
+                         (self.timeout, self.fallback.name))
+        self.fallback.put(queue, op)
+
+    def release(self, queue):
+        if self.saturated and not queue.full():
+            self.saturated = False
+        self.fallback.release(queue)
+
+    def status(self):
+        status = Fallback.status(self)
+        status.update(timeout=self.timeout, saturated=self.saturated,
+                      timeouts=self.timeouts)
+        return status
+
+
+class Coalesce(Fallback):
+    """Merges the operation into the one waiting for the same document,
+    which takes no room. Other operations go to the fallback policy.
+    """
+    name = 'coalesce'
+
+    def put(self, queue, op):
+        # behind the held operations of the document, if any
+        if self.fallback.holding(op) or not queue.merge(op):
+            self.fallback.put(queue, op)
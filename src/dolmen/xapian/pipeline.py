@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Multi-process document preparation.
+
+Resolving content and building its document is usually the costly part
+of indexing. A `Pipeline` runs `IIndexOperation.prepare` in a pool of
+worker processes, while the queue processor thread remains the only
+one writing to the index connection.
+
+Workers are forked when the pipeline starts, inheriting the component
+registrations of the parent process. Applications needing per-process
+setup (database connections, ...) can provide an `initializer`. As
+workers have no index connection, `prepare` is called with None.
+"""
+
+import Queue
+import logging
+import multiprocessing
+import traceback
+
+from dolmen.xapian import interfaces
+
+log = logging.getLogger('dolmen.xapian')
+
+
+def work(inbox, outbox, initializer=None):
+    """Worker process loop: prepares operations until it gets None.
+    """
+    if initializer is not None:
+        initializer()
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        ticket, op = item
+        try:
+            payload = op.prepare(None)
+        except Exception:
+            outbox.put((ticket, None, traceback.format_exc()))
+        else:
+            outbox.put((ticket, payload, None))
+
+
+class Pipeline(object):
+    """Prepares operations in worker processes and hands them back in
+    submission order. Operations on a document are always routed to
+    the same worker, and at most `window` operations are in flight,
+    which bounds the worker queues.
+    """
+
+    # seconds to wait for a result before checking on the workers
+    timeout = 30
+
+    def __init__(self, processes=None, window=1000, initializer=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.window = window
+        self.initializer = initializer
+        self.workers = []
+        self.inboxes = []
+        self.outbox = None
+
+    def start(self):
+        self.outbox = multiprocessing.Queue(self.window)
+        self.workers = [None] * self.processes
+        self.inboxes = [None] * self.processes
+        for index in range(self.processes):
+            self._spawn(index)
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.inboxes = []
+        self.outbox = None
+
+    def _spawn(self, index):
+        inbox = multiprocessing.Queue(self.window)
+        worker = multiprocessing.Process(
+            target=work, args=(inbox, self.outbox, self.initializer))
+        worker.daemon = True
+        worker.start()
+        self.inboxes[index] = inbox
+        self.workers[index] = worker
+
+    def _route(self, op):
+        return hash(op.document_id) % self.processes
+
+    def _recover(self, inflight):
+        """Respawns dead workers and resubmits what they were given.
+        """
+        for index, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            log.error("Pipeline worker %s died (exit code %s), restarting" %
+                      (worker.pid, worker.exitcode))
+            self._spawn(index)
+            for ticket in sorted(inflight):
+                op, route = inflight[ticket]
+                if route == index:
+                    self.inboxes[index].put((ticket, op))
+
+    def prepare(self, ops, failed=None):
+        """Yields (op, payload) for the given operations, in order.
+        Operations failing to prepare are logged and skipped, and passed
+        to `failed` with the error when given.
+        """
+        ops = iter(ops)
+        inflight = {}
+        ready = {}
+        submitted = done = 0
+        exhausted = False
+
+        while True:
+            while not exhausted and submitted - done < self.window:
+                try:
+                    op = ops.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                if interfaces.IDeleteOperation.providedBy(op):
+                    # nothing to build, keep it in line
+                    ready[submitted] = (op, None, None)
+                else:
+                    route = self._route(op)
+                    inflight[submitted] = (op, route)
+                    self.inboxes[route].put((submitted, op))
+                submitted += 1
+
+            while done in ready:
+                op, payload, error = ready.pop(done)
+                done += 1
+                if error is not None:
+                    log.error("Error During Operation %r %r\n%s" %
+                              (op.document_id, op, error))
+                    if failed is not None:
+                        failed(op, error)
+                    continue
+                yield op, payload
+
+            if done == submitted:
+                if exhausted:
+                    return
+                continue
+
+            try:
+                ticket, payload, error = self.outbox.get(True, self.timeout)
+            except Queue.Empty:
+                self._recover(inflight)
+                continue
+
+            entry = inflight.pop(ticket, None)
+            if entry is None:
+                # a late answer for a resubmitted operation
+                continue
+            ready[ticket] = (entry[0], payload, error)
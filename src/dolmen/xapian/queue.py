@@ -19,77 +19,805 @@
 $Id: $
 """
 
-import Queue, threading
+import Queue, threading, time, traceback
+from hashlib import md5
+from collections import OrderedDict, deque
 from logging import getLogger
 from dolmen.xapian import interfaces
+from dolmen.xapian.search import bump_generation
+from dolmen.xapian.metrics import metrics
+from dolmen.xapian.results import ObjectCache
+
+log = getLogger('dolmen.xapian')
+
+
+class IndexQueue(Queue.Queue):
+    """The queue feeding the indexer thread. Operations are numbered
+    in the order they are queued, and the queue processor checkpoints
+    them once they are flushed to the index: `position` is the number
+    up to which all operations are indexed, and `wait` blocks until it
+    reaches a given number.
+
+    When coalescing, operations waiting for the same document are
+    merged into the one effective operation (see `operation.combine`,
+    the later operation wins). The merged operation keeps the place of
+    the first one in the queue.
+
+    A queue with a `maxsize` hands the operations it has no room for
+    to its `overflow` policy (see the `overflow` module) instead of
+    blocking the committing thread. The policy defaults to waiting a
+    second for room, then dropping.
+
+    A queue given `lanes`, a mapping of lane names to weights, keeps
+    the operations of each lane apart and takes from the lanes in
+    proportion to their weights. Operations go to the lane they name,
+    or to the lane with the highest weight. The operations of a
+    document stay in the lane where the first one waits, to be applied
+    in order, unless coalescing merges them into a more urgent lane.
+    """
+
+    def __init__(self, maxsize=0, coalesce=False, overflow=None,
+                 lanes=None):
+        self.coalesce = coalesce
+        if maxsize and overflow is None:
+            from dolmen.xapian.overflow import Block
+            overflow = Block()
+        self.overflow = overflow
+        self.weights = lanes
+        # number of operations the queue had no room for
+        self.overflowed = 0
+        Queue.Queue.__init__(self, maxsize)
+        # notified when the indexed position advances
+        self.advanced = threading.Condition(self.mutex)
+
+    def _init(self, maxsize):
+        self.sequence = 0
+        # numbers of the operations not indexed yet
+        self.outstanding = set()
+        # numbers of the operations merged into another, by its number
+        self.absorbed = {}
+        self.position = 0
+        # number of operations made redundant by coalescing
+        self.coalesced = 0
+        if self.coalesce:
+            from dolmen.xapian.operation import combine
+            self.combine = combine
+        if self.weights:
+            names = sorted(self.weights, key=self.weights.get, reverse=True)
+            self.default = names[0]
+            self.lanes = OrderedDict(
+                (name, self._store()) for name in names)
+            self.credits = dict.fromkeys(names, 0)
+            # lane and number of waiting operations, by document
+            self.waiting = {}
+            self.size = 0
+        else:
+            self.queue = self._store()
+
+    def _store(self):
+        if self.coalesce:
+            return OrderedDict()
+        return deque()
+
+    def _qsize(self, len=len):
+        if self.weights:
+            return self.size
+        return len(self.queue)
+
+    def _number(self, op):
+        self.sequence += 1
+        op.seq = self.sequence
+        self.outstanding.add(op.seq)
+
+    def _put(self, op):
+        if op.seq is None:
+            self._number(op)
+        else:
+            self.outstanding.add(op.seq)
+        if op.queued is None:
+            op.queued = time.time()
+        if self.weights:
+            return self._put_lane(op)
+        if not self.coalesce:
+            self.queue.append(op)
+            return
+
+        key = op.document_id
+        previous = self.queue.get(key)
+        if previous is None:
+            self.queue[key] = op
+            return
+
+        self.queue[key] = self._combine(previous, op)
+
+    def _combine(self, previous, op):
+        """Coalesces two operations on a document, returns the one to
+        keep in the queue, if any.
+        """
+        chosen = self.combine(previous, op)
+        # waiting since the first one was queued
+        chosen.queued = previous.queued
+        for merged in (previous, op):
+            self._absorb(chosen, merged)
+        self.coalesced += 1
+        return chosen
+
+    def lane_of(self, op):
+        if op.lane in self.lanes:
+            return op.lane
+        return self.default
+
+    def _put_lane(self, op):
+        lane = self.lane_of(op)
+        key = op.document_id
+        waiting = self.waiting.get(key)
+        if waiting is None:
+            self.waiting[key] = [lane, 1]
+            if self.coalesce:
+                self.lanes[lane][key] = op
+            else:
+                self.lanes[lane].append(op)
+            self.size += 1
+            return
+
+        if not self.coalesce:
+            # behind the waiting operations of the document
+            waiting[1] += 1
+            self.lanes[waiting[0]].append(op)
+            self.size += 1
+            return
+
+        store = self.lanes[waiting[0]]
+        chosen = self._combine(store[key], op)
+        if self.weights[lane] > self.weights[waiting[0]]:
+            del store[key]
+            store = self.lanes[lane]
+            waiting[0] = lane
+            chosen.lane = op.lane
+        store[key] = chosen
+
+    def _schedule(self):
+        """Picks the lane to take an operation from: each lane earns
+        its weight in credits, the richest pays for the others.
+        """
+        chosen = None
+        total = 0
+        credits = self.credits
+        for name, store in self.lanes.iteritems():
+            if not store:
+                continue
+            weight = self.weights[name]
+            credits[name] += weight
+            total += weight
+            if chosen is None or credits[name] > credits[chosen]:
+                chosen = name
+        credits[chosen] -= total
+        return chosen
+
+    def _get_lane(self):
+        store = self.lanes[self._schedule()]
+        if self.coalesce:
+            key, op = store.popitem(False)
+        else:
+            op = store.popleft()
+            key = op.document_id
+        waiting = self.waiting[key]
+        waiting[1] -= 1
+        if not waiting[1]:
+            del self.waiting[key]
+        self.size -= 1
+        return op
+
+    def put(self, op, block=True, timeout=None):
+        if op.seq is None:
+            # numbered before an overflow policy may hold it
+            self.mutex.acquire()
+            try:
+                self._number(op)
+            finally:
+                self.mutex.release()
+        policy = self.overflow
+        if policy is None:
+            return Queue.Queue.put(self, op, block, timeout)
+        if not policy.holding(op):
+            try:
+                return Queue.Queue.put(self, op, False)
+            except Queue.Full:
+                pass
+        self.overflowed += 1
+        policy.put(self, op)
+
+    def put_many(self, ops):
+        """Queues the operations of a transaction.
+        """
+        policy = self.overflow
+        if policy is None:
+            for op in ops:
+                self.put(op)
+            return
+        # the policy may bound the wait of the whole transaction
+        policy.begin()
+        try:
+            for op in ops:
+                self.put(op)
+        finally:
+            policy.end()
+
+    def get(self, block=True, timeout=None):
+        if self.overflow is not None:
+            self.overflow.release(self)
+        return Queue.Queue.get(self, block, timeout)
+
+    def merge(self, op):
+        """Coalesces the operation into the one waiting for the same
+        document, even when the queue is full. Returns False if there
+        is none.
+        """
+        if not self.coalesce:
+            return False
+        self.mutex.acquire()
+        try:
+            if self.weights:
+                waiting = op.document_id in self.waiting
+            else:
+                waiting = op.document_id in self.queue
+            if not waiting:
+                return False
+            self._put(op)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+        finally:
+            self.mutex.release()
+
+    def urgent(self, op):
+        """Tells if the operation belongs to the most urgent lane.
+        """
+        return bool(self.weights) and self.lane_of(op) == self.default
+
+    def status(self):
+        status = dict(size=self.qsize(), maxsize=self.maxsize,
+                      coalesce=self.coalesce, coalesced=self.coalesced,
+                      overflowed=self.overflowed, policy=None)
+        if self.overflow is not None:
+            status['policy'] = self.overflow.status()
+        if self.weights:
+            self.mutex.acquire()
+            try:
+                status['lanes'] = dict(
+                    (name, dict(size=len(store), weight=self.weights[name]))
+                    for name, store in self.lanes.items())
+            finally:
+                self.mutex.release()
+        return status
+
+    def _get(self):
+        if self.weights:
+            return self._get_lane()
+        if self.coalesce:
+            return self.queue.popitem(False)[1]
+        return self.queue.popleft()
+
+    def _first(self, store):
+        if not store:
+            return None
+        if self.coalesce:
+            return store.itervalues().next().queued
+        return store[0].queued
+
+    def oldest(self):
+        """Returns when the oldest waiting operation was queued.
+        """
+        self.mutex.acquire()
+        try:
+            if not self.weights:
+                return self._first(self.queue)
+            queued = [self._first(store) for store in self.lanes.values()]
+            queued = [when for when in queued if when is not None]
+            return queued and min(queued) or None
+        finally:
+            self.mutex.release()
+
+    def _absorb(self, survivor, op):
+        """Called for operations merged into `survivor`: they are not
+        indexed before it is, and are replayed from a journal until
+        then.
+        """
+        if op.seq == survivor.seq:
+            return
+        absorbed = self.absorbed.setdefault(survivor.seq, [])
+        absorbed.append(op.seq)
+        absorbed.extend(self.absorbed.pop(op.seq, ()))
+
+    def absorb(self, survivor, op):
+        """Records an operation merged into another by an overflow
+        policy.
+        """
+        self.mutex.acquire()
+        try:
+            self._absorb(survivor, op)
+        finally:
+            self.mutex.release()
+
+    def newer(self, op):
+        """Tells if a later operation on the document of `op` is
+        waiting in the queue.
+        """
+        key = op.document_id
+        self.mutex.acquire()
+        try:
+            if self.weights:
+                stores = self.lanes.values()
+            else:
+                stores = [self.queue]
+            for store in stores:
+                if self.coalesce:
+                    waiting = store.get(key)
+                    if waiting is not None and waiting.seq > op.seq:
+                        return True
+                    continue
+                for waiting in store:
+                    if waiting.document_id == key and waiting.seq > op.seq:
+                        return True
+            return False
+        finally:
+            self.mutex.release()
+
+    def _discard(self, op):
+        """Called for operations indexed or given up, with the ones
+        merged into them.
+        """
+        self.outstanding.discard(op.seq)
+        for seq in self.absorbed.pop(op.seq, ()):
+            self.outstanding.discard(seq)
+
+    def forget(self, op):
+        """Acknowledges an operation dropped by an overflow policy.
+        """
+        self.mutex.acquire()
+        try:
+            self._discard(op)
+        finally:
+            self.mutex.release()
+
+    def sync(self):
+        """Makes the queued operations durable, when supported.
+        """
+
+    def checkpoint(self, ops):
+        """Acknowledges operations which made it to the index, and
+        wakes up the threads waiting for them.
+        """
+        self.mutex.acquire()
+        try:
+            for op in ops:
+                self._discard(op)
+            if self.outstanding:
+                position = min(self.outstanding) - 1
+            else:
+                position = self.sequence
+            if position > self.position:
+                self.position = position
+                self._checkpoint(position)
+                self.advanced.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def _checkpoint(self, position):
+        """Called with the queue locked when the position advances.
+        """
+
+    def mark(self, ops):
+        """Returns what to `wait` for to see the operations indexed.
+        """
+        return max(op.seq for op in ops)
+
+    def wait(self, mark, timeout=None):
+        """Waits until the operations up to `mark` are indexed, for at
+        most `timeout` seconds. Returns False if they are not.
+        """
+        self.mutex.acquire()
+        try:
+            if timeout is None:
+                while self.position < mark:
+                    self.advanced.wait()
+                return True
+            deadline = time.time() + timeout
+            while self.position < mark:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.advanced.wait(remaining)
+            return True
+        finally:
+            self.mutex.release()
+
+    def close(self):
+        """Releases the resources held by the queue.
+        """
+
 
 # we do async indexing with all indexing operations put into this queue
-index_queue = Queue.Queue()
+index_queue = IndexQueue()
+
+
+def set_queue(new):
+    """Replaces the index queue, ie. with a `journal.JournalQueue`.
+    This is to be done before the queue processor is started.
+    """
+    global index_queue
+    if not index_queue.empty():
+        log.warn("Replacing an index queue with pending operations")
+    index_queue = new
+
+
+# default lane weights, ie. IndexQueue(lanes=LANES)
+LANES = {interfaces.LANE_INTERACTIVE: 10, interfaces.LANE_BULK: 1}
+
+
+def status():
+    """Returns the state of the index queue and of its overflow policy.
+    """
+    return index_queue.status()
+
+
+def queue_age():
+    oldest = getattr(index_queue, 'oldest', None)
+    queued = oldest is not None and oldest() or None
+    if queued is None:
+        return 0.0
+    return time.time() - queued
+
+
+metrics.gauge('queue.depth', lambda: index_queue.qsize())
+metrics.gauge('queue.age', queue_age)
+metrics.gauge('queue.position', lambda: getattr(index_queue, 'position', 0))
+metrics.gauge('queue.coalesced',
+              lambda: getattr(index_queue, 'coalesced', 0))
+
+
+def document_size(doc):
+    """Rough weight, in bytes, of a prepared document.
+    """
+    if doc is None:
+        return 0
+    return sum(len(field.value) for field in doc.fields)
+
+
+def document_digest(doc):
+    """Digest of the fields of a prepared document.
+    """
+    digest = md5()
+    for field in doc.fields:
+        value = field.value
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest.update('%s\0%s\0%s\0' % (
+            field.name, getattr(field, 'weight', 1), len(value)))
+        digest.update(value)
+    return digest.digest()
 
-log = getLogger('dolmen.xapian')
 
 # async queue processor
 class QueueProcessor( object ):
 
-    # Flush every _n_ changes to the db
-    FLUSH_THRESHOLD = 20
+    # Flush once _n_ changes are pending
+    FLUSH_THRESHOLD = 1000
+
+    # Flush once the pending documents weigh _n_ bytes
+    FLUSH_BYTES = 8 * 1024 * 1024
+
+    # Flush at most _n_ seconds after the first pending change
+    FLUSH_INTERVAL = 5
+
+    # Process at most _n_ operations per batch
+    BATCH_SIZE = 500
+
+    # Spend at most _n_ seconds draining the queue for a batch
+    BATCH_TIMEOUT = 0.5
+
+    # Flush at most _n_ seconds after the first pending change of the
+    # most urgent lane, for queues with lanes
+    PROMPT_INTERVAL = 0.5
 
     # Poll every _n_ seconds for changes
     POLL_TIMEOUT = 60
 
+    # Remember the digests of the last _n_ documents written, to skip
+    # modifications leaving them unchanged. 0 disables the check.
+    DIGESTS = 100000
+
     indexer_running = False
     indexer_thread = None
 
-    def __init__( self, connection ):
-        self.connection = connection 
+    def __init__( self, connection, pipeline=None, index_path=None,
+                  queue=None, retry=None, maintenance=None ):
+        self.connection = connection
+        self.pipeline = pipeline
+        # a retry.RetryScheduler taking the failed operations
+        self.retry = retry
+        # a maintenance.Maintenance compacting the index now and then
+        self.maintenance = maintenance
+        # the queue to drain, the module index queue by default
+        self._queue = queue
+        # where to signal the search connections after flushing
+        self.index_path = index_path or getattr(
+            connection, '_indexpath', None)
+        self.pending_ops = 0
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.urgent_since = None
+        # operations taken from the queue since the last flush, by number
+        self.done = OrderedDict()
+        self.digests = ObjectCache(self.DIGESTS)
+        # modifications skipped as their document was unchanged
+        self.skipped = 0
 
-    def operations( self ):
-        # iterator never ends, just sleeps when no results to process
-        while self.indexer_running:
-            # get an operation in blocking fashion
+    @property
+    def queue( self ):
+        if self._queue is None:
+            return index_queue
+        return self._queue
+
+    def batch( self, timeout ):
+        """Waits up to `timeout` seconds for an operation, then takes
+        everything else that is ready, within the batch limits. The
+        batch ends with an operation of the most urgent lane, not to
+        build more documents before writing it.
+        """
+        try:
+            op = self.queue.get(True, timeout)
+        except Queue.Empty:
+            return []
+        ops = [op]
+        urgent = getattr(self.queue, 'urgent', None)
+        deadline = time.time() + self.BATCH_TIMEOUT
+        while len(ops) < self.BATCH_SIZE and time.time() < deadline:
+            if urgent is not None and urgent(op):
+                break
             try:
-                op = index_queue.get(True, self.POLL_TIMEOUT )
+                op = self.queue.get_nowait()
             except Queue.Empty:
-                yield None
+                break
+            ops.append(op)
+        return ops
+
+    def batches( self ):
+        # iterator never ends, yields empty batches on timeouts
+        while self.indexer_running:
+            if self.pending_since is None:
+                timeout = self.POLL_TIMEOUT
             else:
-                yield op                
+                deadline = self.pending_since + self.FLUSH_INTERVAL
+                if self.urgent_since is not None:
+                    deadline = min(
+                        deadline, self.urgent_since + self.PROMPT_INTERVAL)
+                timeout = max(deadline - time.time(), 0)
+            yield self.batch(timeout)
 
-    def __call__( self ):
-        # number of documents indexed since last flush
-        op_delta = 0
-
-        # loop through queue iteration
-        for op in self.operations():
-
-            # on timeout the op is none
-            if op is None:
-                # if we indexed anything since the last flush, flush it now
-                if op_delta:
-                    if interfaces.DEBUG_LOG:
-                        log.info("QueueProcessor:Timeout Flushing Index %s Pending Ops"%op_delta)
-                    self.connection.flush()
-                    op_delta = 0
-                continue
-            # process the operation
+    def prepare( self, ops ):
+        """Yields (op, payload) for the operations of a batch, building
+        their documents in this thread or through the pipeline.
+        """
+        if self.pipeline is not None:
+            for prepared in self.pipeline.prepare(ops, self.failed):
+                yield prepared
+            return
+
+        for op in ops:
             if interfaces.DEBUG_LOG:
                 log.debug("Processing Operation %r %r"%(op.document_id, op))
             try:
-                result = op.process(self.connection)
+                payload = op.prepare(self.connection)
             except:
                 log.exception("Error During Operation %r %r" %
                               (op.document_id, op))
+                self.failed(op, traceback.format_exc())
                 continue
-            
-            op_delta += 1
-            
-            if op_delta % self.FLUSH_THRESHOLD == 0:
-                if interfaces.DEBUG_LOG:
-                    log.info("QueueProcessor:Delta Flushing Index %s Pending Ops"%op_delta)
-                self.connection.flush()
-                op_delta = 0
-            
+            yield op, payload
+
+    def failed( self, op, error, stage='prepare' ):
+        """Counts an operation which failed to be prepared or written,
+        per kind and per stage, and hands it to the retry scheduler, if
+        any.
+        """
+        metrics.increment('failed.%s' % op.kind)
+        metrics.increment('failed.%s' % stage)
+        if self.retry is not None and self.retry.schedule(op, error):
+            # checkpointed once retried
+            self.done.pop(op.seq, None)
+
+    def succeeded( self, op ):
+        if self.retry is not None:
+            self.retry.cancel(op)
+
+    def widen( self, ops ):
+        """Documents may be built before the earlier operations of the
+        batch are written: a partial modification of a document changed
+        earlier in the batch also covers the attributes changed then, or
+        all of them after another kind of operation.
+        """
+        seen = {}
+        for op in ops:
+            previous = seen.get(op.document_id)
+            seen[op.document_id] = op
+            if (previous is None or op.attributes is None or
+                op.kind != interfaces.OP_MODIFED):
+                continue
+            if (previous.kind == interfaces.OP_MODIFED and
+                previous.attributes is not None):
+                op.attributes = previous.attributes | op.attributes
+            else:
+                op.attributes = None
+
+    def process( self, ops ):
+        """Builds the documents of a batch, then writes them.
+        """
+        for op in ops:
+            self.done[op.seq] = op
+            if self.retry is not None:
+                self.retry.supersede(op)
+        self.widen(ops)
+        urgent = getattr(self.queue, 'urgent', None)
+        if urgent is not None and self.urgent_since is None:
+            for op in ops:
+                if urgent(op):
+                    self.urgent_since = time.time()
+                    break
+
+        if self.pipeline is not None:
+            # writes proceed while the workers are building
+            self.write(self.prepare(ops))
+        else:
+            # build documents ahead of writing them, up to FLUSH_BYTES
+            prepared = []
+            size = 0
+            for op, payload in self.prepare(ops):
+                prepared.append((op, payload))
+                size += document_size(payload)
+                if size >= self.FLUSH_BYTES:
+                    self.write(prepared)
+                    prepared = []
+                    size = 0
+            self.write(prepared)
+
+        if self.pending_ops and self.pending_since is None:
+            self.pending_since = time.time()
+
+    def write( self, prepared ):
+        """Writes prepared documents, skipping unchanged ones.
+        """
+        for op, payload in prepared:
+            digest = self.digest(op, payload)
+            if self.unchanged(op, digest):
+                self.succeeded(op)
+                continue
+            try:
+                if metrics.sampling():
+                    started = time.time()
+                    op.apply(self.connection, payload)
+                    metrics.timing('write', time.time() - started)
+                else:
+                    op.apply(self.connection, payload)
+            except:
+                log.exception("Error During Operation %r %r" %
+                              (op.document_id, op))
+                # not sure of what the index holds anymore
+                self.digests.discard(op.document_id)
+                self.failed(op, traceback.format_exc(), 'write')
+                continue
+            metrics.increment('processed.%s' % op.kind)
+            self.succeeded(op)
+            if digest is None:
+                self.digests.discard(op.document_id)
+            else:
+                self.digests.set(op.document_id, digest)
+            self.pending_ops += 1
+            self.pending_bytes += document_size(payload)
+
+    def digest( self, op, payload ):
+        """Returns the digest of the document to write, or None when
+        there is no document or when digests are not kept.
+        """
+        if not self.DIGESTS or payload is None:
+            return None
+        return document_digest(payload)
+
+    def unchanged( self, op, digest ):
+        """Tells if a modification would write the document as it is
+        already in the index.
+        """
+        if (digest is None or op.kind != interfaces.OP_MODIFED or
+            self.digests.get(op.document_id) != digest):
+            return False
+        self.skipped += 1
+        metrics.increment('skipped.unchanged')
+        return True
+
+    def should_flush( self ):
+        if not self.pending_ops:
+            return False
+        now = time.time()
+        return (self.pending_ops >= self.FLUSH_THRESHOLD or
+                self.pending_bytes >= self.FLUSH_BYTES or
+                now - self.pending_since >= self.FLUSH_INTERVAL or
+                (self.urgent_since is not None and
+                 now - self.urgent_since >= self.PROMPT_INTERVAL))
+
+    def flush( self ):
+        if interfaces.DEBUG_LOG:
+            log.info("QueueProcessor:Flushing Index %s Pending Ops (%s bytes)"
+                     % (self.pending_ops, self.pending_bytes))
+        started = time.time()
+        self.connection.flush()
+        metrics.flushed(self.pending_ops, self.pending_bytes,
+                        time.time() - started)
+        self.pending_ops = 0
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.urgent_since = None
+        if self.index_path is not None:
+            bump_generation(self.index_path)
+        self.checkpoint()
+
+    def checkpoint( self ):
+        if self.done:
+            self.queue.checkpoint(self.done.values())
+            self.done = OrderedDict()
+
+    def __call__( self ):
+        if self.retry is not None:
+            self.retry.start(self.queue)
+
+        for ops in self.batches():
+            if ops:
+                self.process(ops)
+            if self.should_flush():
+                self.flush()
+            elif not self.pending_ops:
+                # nothing written, ie. failed operations
+                self.checkpoint()
+            if self.maintenance is not None and self.maintenance.due():
+                # the queue holds the operations meanwhile
+                self.maintenance.run(self)
+
+        # don't leave written operations unflushed on shutdown
+        if self.pending_ops:
+            self.flush()
+        self.queue.sync()
+
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.retry is not None:
+            # the waiting retries are replayed from a journal
+            self.retry.stop()
+
+    def spawn( self ):
+        """Runs this processor in a thread of its own, ie. one per shard
+        when writing to several indexes.
+        """
+        self.indexer_running = True
+        if self.pipeline is not None:
+            self.pipeline.start()
+        self.indexer_thread = threading.Thread(target=self)
+        self.indexer_thread.setDaemon(True)
+        self.indexer_thread.start()
+
+    def halt( self ):
+        """Stops a processor started with `spawn`.
+        """
+        self.indexer_running = False
+        self.indexer_thread.join()
+
     @classmethod
-    def start(klass, connection, silent=False):
+    def start(klass, connection, silent=False, pipeline=None,
+              index_path=None, retry=None, maintenance=None):
+        """Starts the indexer thread. Passing a `pipeline.Pipeline`
+        moves document preparation to its worker processes, passing a
+        `retry.RetryScheduler` retries the failed operations, passing a
+        `maintenance.Maintenance` compacts the index now and then. The
+        index path defaults to the one of the connection.
+        """
         if klass.indexer_running:
             if silent:
                 return
@@ -100,7 +828,11 @@ class QueueProcessor( object ):
             log.debug("Index Fields Defined")
             
         klass.indexer_running = True
-        indexer = klass(connection)
+        indexer = klass(connection, pipeline, index_path, retry=retry,
+                        maintenance=maintenance)
+        if pipeline is not None:
+            # fork the workers before the indexer thread is running
+            pipeline.start()
         klass.indexer_thread = threading.Thread(target=indexer)
         klass.indexer_thread.setDaemon(True)
         klass.indexer_thread.start()
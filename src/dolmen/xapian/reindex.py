@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Rebuilding an index from scratch.
+
+The ids of every resolver providing `ids` (see `IEnumerableResolver`)
+are split in chunks, which worker processes index into shard databases.
+The shards are then merged into a fresh index, swapped in place of the
+current one. The index path must be a symbolic link to the index
+directory, which is pointed to the new index atomically, or not exist
+yet.
+
+Each indexed chunk is recorded in a progress file of the work
+directory, so an interrupted rebuild can be resumed: resolvers need to
+enumerate their ids in a stable order for this to work.
+
+The queue processor writing to the index should be stopped during the
+rebuild, and restarted on the new index once it is swapped in. The
+operations queued meanwhile are then applied to the new index.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import optparse
+import multiprocessing
+import Queue
+import xappy
+
+from zope.component import getUtilitiesFor
+from dolmen.xapian.interfaces import IResolver
+from dolmen.xapian.operation import ModifyOperation
+from dolmen.xapian.search import read_generation, write_generation
+
+log = logging.getLogger('dolmen.xapian')
+
+
+def chunks(chunk_size):
+    """Yields (resolver_id, ids) for all the enumerable content.
+    """
+    for resolver_id, resolver in sorted(getUtilitiesFor(IResolver)):
+        ids = getattr(resolver, 'ids', None)
+        if ids is None:
+            log.warn("Reindex: resolver %r can't enumerate its content"
+                     % resolver_id)
+            continue
+        chunk = []
+        for id in ids():
+            chunk.append(id)
+            if len(chunk) >= chunk_size:
+                yield resolver_id, chunk
+                chunk = []
+        if chunk:
+            yield resolver_id, chunk
+
+
+def build_shard(path, setup, tasks, results, initializer=None):
+    """Worker process loop: indexes the chunks it gets into a shard.
+    """
+    if initializer is not None:
+        initializer()
+    created = not os.path.exists(path)
+    connection = xappy.IndexerConnection(path)
+    if created:
+        setup(connection)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        number, resolver_id, ids = task
+        indexed = 0
+        for id in ids:
+            # replacing keeps resumed chunks from duplicating documents
+            try:
+                ModifyOperation(id, resolver_id).process(connection)
+            except:
+                log.exception("Reindex: error indexing %r" % id)
+                continue
+            indexed += 1
+        connection.flush()
+        results.put((number, len(ids), indexed))
+    connection.close()
+
+
+def merge(shards, path, setup):
+    """Copies the documents of the shards into a new index. The shards
+    and the new index share their field actions, so processed documents
+    can go from one to the other.
+    """
+    target = xappy.IndexerConnection(path)
+    setup(target)
+    for shard in shards:
+        source = xappy.SearchConnection(shard)
+        for id in source.iterids():
+            target.replace(source.get_document(id))
+        source.close()
+        target.flush()
+    target.close()
+
+
+def swap(index_path, new_path):
+    """Puts the index at `new_path` in place of the one at `index_path`
+    and returns where the previous index lives, None if there was none.
+
+    `index_path` is a symbolic link, atomically pointed to the new
+    index, or is created as one. Renaming directories would leave no
+    index for a moment, a `ValueError` is raised instead.
+    """
+    check_swappable(index_path)
+    if not os.path.islink(index_path):
+        os.symlink(os.path.abspath(new_path), index_path)
+        return None
+
+    # the search connections will notice the change
+    write_generation(new_path, read_generation(index_path) + 1)
+    previous = os.path.realpath(index_path)
+    link = index_path + '.swap'
+    if os.path.lexists(link):
+        # left by an interrupted swap
+        os.remove(link)
+    os.symlink(os.path.abspath(new_path), link)
+    os.rename(link, index_path)
+    return previous
+
+
+def check_swappable(index_path):
+    """Raises a `ValueError` unless an index can be swapped in at
+    `index_path`.
+    """
+    if os.path.lexists(index_path) and not os.path.islink(index_path):
+        raise ValueError(
+            "%s is not a symbolic link, move the index and link to it "
+            "to swap indexes atomically" % index_path)
+
+
+class Progress(object):
+    """The chunks done so far, recorded in the work directory.
+    """
+
+    def __init__(self, path):
+        self.filename = os.path.join(path, 'progress')
+        self.done = set()
+        self.ids = 0
+        if os.path.exists(self.filename):
+            for line in open(self.filename):
+                number, count = map(int, line.split())
+                self.done.add(number)
+                self.ids += count
+        self.fh = open(self.filename, 'a')
+
+    def record(self, number, count):
+        self.fh.write('%d %d\n' % (number, count))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.done.add(number)
+        self.ids += count
+
+    def close(self):
+        self.fh.close()
+
+
+def log_progress(chunks, ids, elapsed):
+    log.info("Reindex: %s chunks, %s documents, %.1f documents/s" %
+             (chunks, ids, ids / max(elapsed, 0.001)))
+
+
+def reindex(index_path, setup, processes=None, chunk_size=1000,
+            resume=False, work_path=None, progress=log_progress,
+            initializer=None):
+    """Rebuilds the index at `index_path`. `setup` is called with new
+    indexer connections to add the field actions of the index.
+    """
+    # rather than once the rebuild is done
+    check_swappable(index_path)
+    processes = processes or multiprocessing.cpu_count()
+    work_path = work_path or index_path + '.reindex'
+    if not resume and os.path.exists(work_path):
+        shutil.rmtree(work_path)
+    if not os.path.exists(work_path):
+        os.makedirs(work_path)
+
+    state = Progress(work_path)
+    shards = [os.path.join(work_path, 'shard-%d' % i)
+              for i in range(processes)]
+    tasks = multiprocessing.Queue(processes * 2)
+    results = multiprocessing.Queue()
+    workers = []
+    for shard in shards:
+        worker = multiprocessing.Process(
+            target=build_shard,
+            args=(shard, setup, tasks, results, initializer))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    started = time.time()
+    outstanding = set()
+
+    def collect(timeout):
+        try:
+            number, count, indexed = results.get(True, timeout)
+        except Queue.Empty:
+            if not [w for w in workers if w.is_alive()]:
+                raise RuntimeError(
+                    "Reindex: workers died with %s chunks left, "
+                    "resume to finish" % len(outstanding))
+            return
+        outstanding.discard(number)
+        state.record(number, count)
+        if indexed < count:
+            log.warn("Reindex: %s documents of chunk %s failed" %
+                     (count - indexed, number))
+        if progress is not None:
+            progress(len(state.done), state.ids, time.time() - started)
+
+    def submit(task):
+        while True:
+            try:
+                tasks.put(task, True, 1)
+                return
+            except Queue.Full:
+                collect(0)
+
+    try:
+        for number, (resolver_id, ids) in enumerate(chunks(chunk_size)):
+            if number in state.done:
+                continue
+            outstanding.add(number)
+            submit((number, resolver_id, ids))
+            collect(0)
+        for worker in workers:
+            submit(None)
+        while outstanding:
+            collect(1)
+    finally:
+        for worker in workers:
+            worker.join(1)
+        state.close()
+
+    merged = '%s.%d' % (index_path.rstrip(os.sep), time.time())
+    # a resumed rebuild may have used more processes, take all shards
+    merge([os.path.join(work_path, name)
+           for name in sorted(os.listdir(work_path))
+           if name.startswith('shard-')], merged, setup)
+    previous = swap(index_path, merged)
+    shutil.rmtree(work_path)
+    log.info("Reindex: %s documents indexed in %.1fs" %
+             (state.ids, time.time() - started))
+    if previous is not None:
+        log.info("Reindex: previous index at %s" % previous)
+    return previous
+
+
+def resolve_dotted(name):
+    module, attribute = name.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attribute]), attribute)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] INDEX_PATH",
+        description="Rebuilds a dolmen.xapian index from its resolvers.")
+    parser.add_option(
+        '-c', '--zcml', help="ZCML file registering resolvers and indexers")
+    parser.add_option(
+        '-s', '--setup',
+        help="dotted name of the function adding the index field actions")
+    parser.add_option(
+        '-i', '--initializer',
+        help="dotted name of a function to call in each worker process")
+    parser.add_option(
+        '-p', '--processes', type='int', help="number of worker processes")
+    parser.add_option(
+        '-n', '--chunk-size', type='int', default=1000,
+        help="number of documents per chunk [default: %default]")
+    parser.add_option(
+        '-r', '--resume', action='store_true', default=False,
+        help="resume an interrupted rebuild")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or not options.setup:
+        parser.error("an index path and a setup function are required")
+
+    logging.basicConfig(level=logging.INFO)
+    if options.zcml:
+        from zope.configuration import xmlconfig
+        xmlconfig.file(options.zcml)
+    initializer = None
+    if options.initializer:
+        initializer = resolve_dotted(options.initializer)
+
+    reindex(args[0], resolve_dotted(options.setup),
+            processes=options.processes, chunk_size=options.chunk_size,
+            resume=options.resume, initializer=initializer)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
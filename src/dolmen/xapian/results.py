@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Resolution of search results into objects.
+
+Search results store the name of their resolver in the `resolver`
+field. `resolve_results` groups the results of a page by resolver and
+resolves each group with one `resolve_many` call when the resolver
+provides it, falling back to `resolve` for each id otherwise.
+"""
+
+from collections import OrderedDict
+from zope.component import getSiteManager, getUtility
+from dolmen.xapian.interfaces import IResolver
+
+# resolver name: (utility registry, its generation, resolver)
+_resolvers = {}
+
+
+def get_resolver(resolver_id):
+    """Returns the resolver of the given name, looked up once until the
+    utility registrations of the site change.
+
+    Changes are told by the generation of the utility registry, bumped
+    by zope.interface on each registration, also in its bases. Without
+    one, the resolver is looked up each time.
+    """
+    resolver_id = resolver_id or u''
+    registry = getSiteManager().utilities
+    generation = getattr(registry, '_generation', None)
+    cached = _resolvers.get(resolver_id)
+    if (generation is not None and cached is not None and
+            cached[0] is registry and cached[1] == generation):
+        return cached[2]
+    resolver = getUtility(IResolver, resolver_id)
+    if generation is not None:
+        _resolvers[resolver_id] = (registry, generation, resolver)
+    return resolver
+
+
+def resolver_of(result):
+    """Returns the resolver name stored with a search result.
+    """
+    return (result.data.get('resolver') or [''])[0]
+
+
+class ObjectCache(object):
+    """A bounded cache of resolved objects, meant to live as long as a
+    request. The least recently used objects are dropped first.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.objects = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            ob = self.objects.pop(key)
+        except KeyError:
+            return default
+        self.objects[key] = ob
+        return ob
+
+    def set(self, key, ob):
+        self.objects.pop(key, None)
+        self.objects[key] = ob
+        while len(self.objects) > self.size:
+            self.objects.popitem(False)
+
+    def discard(self, key):
+        self.objects.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.objects
+
+    def __len__(self):
+        return len(self.objects)
+
+
+def resolve_many(resolver, document_ids):
+    """Returns a mapping of the given ids to their objects.
+    """
+    bulk = getattr(resolver, 'resolve_many', None)
+    if bulk is not None:
+        return bulk(document_ids)
+    return dict((id, resolver.resolve(id)) for id in document_ids)
+
+
+def resolve_results(results, cache=None):
+    """Returns the objects of the results, in order. Objects which
+    couldn't be resolved are returned as None.
+    """
+    keys = [(resolver_of(result), result.id) for result in results]
+    resolved = {}
+    groups = OrderedDict()
+    for key in keys:
+        if key in resolved:
+            continue
+        if cache is not None and key in cache:
+            resolved[key] = cache.get(key)
+            continue
+        groups.setdefault(key[0], []).append(key[1])
+        resolved[key] = None
+
+    for resolver_id, ids in groups.items():
+        objects = resolve_many(get_resolver(resolver_id), ids)
+        for id in ids:
+            ob = objects.get(id)
+            resolved[(resolver_id, id)] = ob
+            if cache is not None and ob is not None:
+                cache.set((resolver_id, id), ob)
+
+    return [resolved[key] for key in keys]
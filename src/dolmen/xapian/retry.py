@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Retrying failed index operations.
+
+Content may not be resolvable yet when the indexer gets its operation,
+ie. when the transaction which added it is not visible to the indexer
+connection yet. A queue processor given a `RetryScheduler` hands the
+operations failing to be prepared or written to it instead of dropping
+them:
+
+  retry = RetryScheduler(dead_letters=DeadLetters('/var/lib/app/dead'))
+  queue.QueueProcessor.start(connection, retry=retry)
+
+Operations are put back in the index queue after a delay doubling with
+each attempt (`requeue` counts them), from a thread of the scheduler,
+so the indexer keeps draining the queue meanwhile. A retry is dropped
+once a later operation on the same document is taken by the indexer,
+or is waiting in the queue when the retry is due: the later operation
+is applied instead. Operations still failing after `max_attempts` go
+to the dead letters, which can be inspected and replayed.
+
+Operations waiting for a retry are not checkpointed: they hold back
+the index queue position and are replayed from a journal on restart.
+"""
+
+import os
+import time
+import json
+import heapq
+import logging
+import threading
+
+from dolmen.xapian import operation, queue
+
+log = logging.getLogger('dolmen.xapian')
+
+
+class DeadLetters(object):
+    """The operations which could not be indexed, kept in a file when
+    given a path.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.letters = []
+        if path is not None and os.path.exists(path):
+            for line in open(path):
+                try:
+                    self.letters.append(json.loads(line))
+                except ValueError:
+                    log.warn("Dead letters: skipping damaged entry")
+
+    def add(self, op, error):
+        letter = dict(kind=op.kind, oid=op.oid, resolver_id=op.resolver_id,
+                      attempts=op.requeue, error=error, time=time.time())
+        self.lock.acquire()
+        try:
+            self.letters.append(letter)
+            if self.path is not None:
+                fh = open(self.path, 'a')
+                try:
+                    fh.write(json.dumps(letter) + '\n')
+                finally:
+                    fh.close()
+        finally:
+            self.lock.release()
+
+    def entries(self):
+        return list(self.letters)
+
+    def __len__(self):
+        return len(self.letters)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.letters = []
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+        finally:
+            self.lock.release()
+
+    def replay(self, index_queue=None):
+        """Queues the dead operations again, returns their number.
+        """
+        if index_queue is None:
+            index_queue = queue.index_queue
+        letters = self.entries()
+        self.clear()
+        for letter in letters:
+            index_queue.put(operation.restore(
+                letter['kind'], letter['oid'], letter['resolver_id']))
+        return len(letters)
+
+
+class RetryScheduler(object):
+    """Puts failed operations back in the index queue after a delay.
+    """
+
+    def __init__(self, max_attempts=5, delay=1.0, max_delay=300,
+                 dead_letters=None):
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        if dead_letters is None:
+            dead_letters = DeadLetters()
+        self.dead_letters = dead_letters
+        self.condition = threading.Condition()
+        # (due time, order, operation)
+        self.heap = []
+        self.order = 0
+        # the operation waiting for a retry, by document
+        self.waiting = {}
+        self.retried = 0
+        self.queue = None
+        self.thread = None
+        self.running = False
+
+    def start(self, index_queue):
+        self.queue = index_queue
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def backoff(self, attempts):
+        return min(self.delay * 2 ** (attempts - 1), self.max_delay)
+
+    def schedule(self, op, error):
+        """Takes a failed operation. Returns False if it went to the
+        dead letters instead.
+        """
+        op.requeue = attempts = (op.requeue or 0) + 1
+        if attempts >= self.max_attempts:
+            log.error("Giving up on %r %r after %s attempts" %
+                      (op.document_id, op, attempts))
+            self.dead_letters.add(op, error)
+            self.queue.forget(op)
+            return False
+
+        self.condition.acquire()
+        try:
+            previous = self.waiting.get(op.document_id)
+            if previous is not None:
+                self.queue.forget(previous)
+            self.waiting[op.document_id] = op
+            self.order += 1
+            heapq.heappush(
+                self.heap, (time.time() + self.backoff(attempts),
+                            self.order, op))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return True
+
+    def cancel(self, op):
+        """Drops the retry of an earlier operation on the document of
+        an operation which succeeded.
+        """
+        if not self.waiting:
+            return
+        self.condition.acquire()
+        try:
+            previous = self.waiting.get(op.document_id)
+            if previous is not None and previous is not op:
+                del self.waiting[op.document_id]
+                self.queue.forget(previous)
+        finally:
+            self.condition.release()
+
+    def supersede(self, op):
+        """Drops the retry of an earlier operation on the document of
+        an operation taken by the indexer, which is applied after it.
+        """
+        if not self.waiting:
+            return
+        self.condition.acquire()
+        try:
+            previous = self.waiting.get(op.document_id)
+            if previous is not None and previous.seq < op.seq:
+                del self.waiting[op.document_id]
+                self.queue.forget(previous)
+        finally:
+            self.condition.release()
+
+    def resume(self, op):
+        """Queues a due operation again, unless a later operation on its
+        document is waiting in the queue. Returns False if it is dropped.
+        """
+        newer = getattr(self.queue, 'newer', None)
+        if newer is not None and newer(op):
+            self.queue.forget(op)
+            return False
+        self.retried += 1
+        self.queue.put(op)
+        return True
+
+    def due(self):
+        """Pops the operations due for a retry.
+        """
+        ops = []
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            op = heapq.heappop(self.heap)[2]
+            if self.waiting.get(op.document_id) is op:
+                del self.waiting[op.document_id]
+                ops.append(op)
+        return ops
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if not self.running:
+                    return
+                ops = self.due()
+                if not ops:
+                    if self.heap:
+                        self.condition.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.condition.wait()
+                    continue
+            finally:
+                self.condition.release()
+            for op in ops:
+                self.resume(op)
+
+    def status(self):
+        return dict(waiting=len(self.waiting), retried=self.retried,
+                    dead=len(self.dead_letters))
@@ -1,53 +1,315 @@
 # -*- coding: utf-8 -*-
 
+import os
 import logging
 import time
+import xapian
 import xappy
 
-from threading import local
+from contextlib import contextmanager
+from threading import local, Condition
 from zope import interface
+from dolmen.xapian.cache import CachedResults
 from dolmen.xapian.interfaces import IIndexSearch
+from dolmen.xapian.metrics import metrics
 
 log = logging.getLogger('dolmen.xapian')
 
+# name of the file holding the index generation, in the index directory
+GENERATION_FILE = 'dolmen.generation'
+
+
+def read_generation(index_path):
+    """Returns the generation of the index, bumped by the writer after
+    each flush.
+    """
+    try:
+        fh = open(os.path.join(index_path, GENERATION_FILE))
+    except IOError:
+        return 0
+    try:
+        return int(fh.read().strip() or 0)
+    except ValueError:
+        return 0
+    finally:
+        fh.close()
+
+
+def write_generation(index_path, generation):
+    filename = os.path.join(index_path, GENERATION_FILE)
+    fh = open(filename + '.tmp', 'w')
+    try:
+        fh.write('%d\n' % generation)
+    finally:
+        fh.close()
+    os.rename(filename + '.tmp', filename)
+
+
+def bump_generation(index_path):
+    """Signals the readers that the index changed on disk. The queue
+    processor bumps the generation after each flush: any other writer
+    has to call it after flushing, or the search connections keep
+    searching the index as it was.
+    """
+    generation = read_generation(index_path) + 1
+    write_generation(index_path, generation)
+    return generation
+
+
+class ShardedSearchConnection(xappy.SearchConnection):
+    """A search connection querying several indexes as one. The
+    indexes share their field actions, which are read from the first.
+    """
+
+    def __init__(self, index_paths):
+        xappy.SearchConnection.__init__(self, index_paths[0])
+        self.index_paths = index_paths
+        for index_path in index_paths[1:]:
+            self._index.add_database(xapian.Database(index_path))
+
+
+def open_connection(index_path):
+    if isinstance(index_path, (list, tuple)):
+        if len(index_path) > 1:
+            return ShardedSearchConnection(index_path)
+        index_path = index_path[0]
+    return xappy.SearchConnection(index_path)
+
+
+def index_generation(index_path):
+    """Returns the generation of an index or of a list of shards.
+    """
+    if isinstance(index_path, (list, tuple)):
+        return sum(read_generation(path) for path in index_path)
+    return read_generation(index_path)
+
+
+class PoolExhausted(Exception):
+    """No search connection could be checked out in time.
+    """
+
 
 class ConnectionHub(object):
-    """Search connection storage and retrieval with automatic
-    reconnections with connection aging, connections are all thread
-    local.
+    """Search connection storage and retrieval. Connections are
+    reopened only when the index revision changed, that is when the
+    writer bumped the index generation (see `bump_generation`) or when
+    the hub is invalidated.
+
+    Connections are checked out of a pool of at most `pool_size`
+    connections, and checked back in, preferably through the
+    `connection` context manager. `get` returns a connection private
+    to the calling thread, outside of the pool: it is not bounded, and
+    stays open as long as the thread lives.
+
+    The index path can be a list of paths to shards, to be searched
+    as one index.
+
+    The `warmup` queries, query strings or callables taking the
+    connection, are run on each connection opened or reopened before
+    it is handed out, see `maintenance.Warmer`.
     """
-    # max time in seconds till we refresh a connection
-    auto_refresh_delta = 20
+    # max time in seconds till we check the index generation
+    auto_refresh_delta = 1
+
+    # max number of pooled connections
+    pool_size = 8
 
-    def __init__(self, index_path):
+    def __init__(self, index_path, pool_size=None, warmup=()):
         self.store = local()
-        self.modified = time.time()
         self.index_path = index_path
+        if pool_size is not None:
+            self.pool_size = pool_size
+        self.warmup = warmup
+        self.generation = index_generation(index_path)
+        self.checked = time.time()
+        self.forced = 0
+        self.reopens = 0
+        self.condition = Condition()
+        self.idle = []
+        self.revisions = {}
+        self.opened = 0
+
+    @property
+    def revision(self):
+        now = time.time()
+        if now - self.checked >= self.auto_refresh_delta:
+            self.checked = now
+            self.generation = index_generation(self.index_path)
+        return self.generation + self.forced
+
+    def current(self, fresh=False):
+        """Returns the index revision. Fresh revisions read the index
+        generation now, instead of at most every `auto_refresh_delta`,
+        ie. for callers which just waited for their changes to be
+        indexed.
+        """
+        if not fresh:
+            return self.revision
+        self.checked = time.time()
+        self.generation = index_generation(self.index_path)
+        return self.generation + self.forced
 
     def invalidate(self):
-        self.modified = time.time()
+        self.forced += 1
 
-    def get(self):
-        conn = getattr(self.store, 'connection', None)
+    def _open(self):
+        conn = open_connection(self.index_path)
+        self.warm(conn)
+        return conn
 
-        now = time.time()
-        if self.modified + self.auto_refresh_delta < now:
-            self.modified = now
+    def _reopen(self, conn):
+        log.warn("Reopening Connection")
+        self.reopens += 1
+        metrics.increment('search.reopens')
+        try:
+            conn.reopen()
+        except Exception:
+            # the index was swapped for another database
+            log.warn("Reopen failed, opening a new connection")
+            conn.close()
+            return self._open()
+        self.warm(conn)
+        return conn
+
+    def warm(self, conn):
+        """Runs the warmup queries, loading the index pages they need.
+        """
+        if not self.warmup:
+            return
+        started = time.time()
+        for query in self.warmup:
+            try:
+                if callable(query):
+                    query(conn)
+                else:
+                    conn.search(conn.query_parse(query), 0, 10)
+            except Exception:
+                log.exception("Warmup query %r failed" % (query,))
+        metrics.timing('search.warmup', time.time() - started)
+
+    def refresh(self):
+        """Reopens the idle connections if the index changed, so they
+        are warm when checked out.
+        """
+        revision = self.current()
+        self.condition.acquire()
+        try:
+            stale = [entry for entry in self.idle if entry[1] != revision]
+            for entry in stale:
+                # checked out meanwhile
+                self.idle.remove(entry)
+        finally:
+            self.condition.release()
+        for conn, opened in stale:
+            try:
+                conn = self._reopen(conn)
+            except Exception:
+                log.exception("Refreshing a connection failed")
+                conn.close()
+                self.condition.acquire()
+                self.opened -= 1
+                self.condition.notify()
+                self.condition.release()
+                continue
+            self.condition.acquire()
+            try:
+                self.idle.append((conn, revision))
+                self.condition.notify()
+            finally:
+                self.condition.release()
+        return len(stale)
+
+    def get(self, fresh=False):
+        """Returns the connection of the calling thread, opened on
+        first use. These connections are not pooled, one is opened per
+        thread calling: use `connection` instead where threads come and
+        go or are many.
+        """
+        revision = self.current(fresh)
+        conn = getattr(self.store, 'connection', None)
 
         if conn is None:
-            self.store.connection = conn = xappy.SearchConnection(
-                self.index_path)
-            self.store.opened = now
+            self.store.connection = conn = self._open()
+        elif self.store.revision != revision:
+            self.store.connection = conn = self._reopen(conn)
 
-        opened = getattr(self.store, 'opened')
+        self.store.revision = revision
+        return conn
 
-        if opened < self.modified:
-            log.warn("Reopening Connection")
-            conn.reopen()
-            self.store.opened = now
+    def checkout(self, timeout=None, fresh=False):
+        """Takes a connection from the pool, waiting at most `timeout`
+        seconds for one to be available.
+        """
+        revision = self.current(fresh)
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.condition.acquire()
+        try:
+            while not self.idle and self.opened >= self.pool_size:
+                if timeout is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        "No search connection available for %s" %
+                        self.index_path)
+                self.condition.wait(remaining)
+            if self.idle:
+                conn, opened = self.idle.pop()
+            else:
+                conn = None
+                self.opened += 1
+        finally:
+            self.condition.release()
+
+        if conn is None:
+            try:
+                conn = self._open()
+            except:
+                self.condition.acquire()
+                self.opened -= 1
+                self.condition.notify()
+                self.condition.release()
+                raise
+        elif opened != revision:
+            conn = self._reopen(conn)
 
+        self.revisions[id(conn)] = revision
         return conn
 
+    def checkin(self, conn):
+        """Gives a checked out connection back to the pool.
+        """
+        revision = self.revisions.pop(id(conn))
+        self.condition.acquire()
+        try:
+            self.idle.append((conn, revision))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    @contextmanager
+    def connection(self, timeout=None, fresh=False):
+        conn = self.checkout(timeout, fresh)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def close(self):
+        """Closes the idle pooled connections.
+        """
+        self.condition.acquire()
+        try:
+            for conn, revision in self.idle:
+                conn.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+        finally:
+            self.condition.release()
+
 
 class IndexSearch(object):
     """A base implementation of an IIndexSearch.
@@ -56,12 +318,58 @@ class IndexSearch(object):
     """
     interface.implements(IIndexSearch)
 
-    def __init__(self, index_path):
+    def __init__(self, index_path, pool_size=None, cache=None, warmup=()):
         self._index_path = index_path
-        self.hub = ConnectionHub(index_path)
+        self.hub = ConnectionHub(index_path, pool_size, warmup)
+        self.cache = cache
+
+    def __call__(self, fresh=False):
+        """Returns the connection of the calling thread, outside of
+        the pool, see `ConnectionHub.get`. Prefer `connection` or
+        `search`.
+        """
+        return self.hub.get(fresh)
+
+    def connection(self, timeout=None, fresh=False):
+        """Context manager lending a pooled search connection.
+        """
+        return self.hub.connection(timeout, fresh)
+
+    def search(self, query, startrank, endrank, fresh=False, facets=None,
+               **options):
+        """Searches using a pooled connection and returns detached
+        results, memoized when the index search has a `ResultCache`.
+        Fresh searches see all the flushed changes, see
+        `operation.wait_for_indexed`. The results keep the facets
+        suggested for the `facets` arguments, when given, a dict which
+        may be empty.
+        """
+        if facets is not None:
+            options['getfacets'] = True
+        if self.cache is not None:
+            revision = self.hub.current(fresh)
+            key = self.cache.key(query, startrank, endrank, dict(
+                options, facets=facets and sorted(facets.items())))
+            results = self.cache.get(key, revision)
+            if results is not None:
+                return results
+
+        with self.hub.connection(fresh=fresh) as conn:
+            results = CachedResults(
+                conn.search(query, startrank, endrank, **options), facets)
+
+        if self.cache is not None:
+            self.cache.set(key, revision, results)
+        return results
 
-    def __call__(self):
-        return self.hub.get()
+    def stream(self, query, window=100, prefetch=False, limit=None,
+               **options):
+        """Iterates over the matches of a query, fetched `window` at a
+        time, see `stream.ResultStream`.
+        """
+        from dolmen.xapian.stream import ResultStream
+        return ResultStream(self._index_path, query, window, prefetch,
+                            limit, **options)
 
     def invalidate(self):
         self.hub.invalidate()
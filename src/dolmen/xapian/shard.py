@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Writing to several indexes.
+
+A `ShardedIndex` spreads the indexing operations over several xapian
+databases, each written by a queue processor of its own. The operation
+buffer keeps putting operations in `queue.index_queue`, which becomes a
+`ShardedQueue` routing them to the queue of their shard.
+
+Routers are called with an operation and the number of shards, and
+return the index of the shard. Operations for a document must always go
+to the same shard. On the search side, a `ConnectionHub` or an
+`IndexSearch` given the list of shard paths searches them as one index.
+"""
+
+import time
+import zlib
+
+from dolmen.xapian import queue
+from dolmen.xapian.queue import IndexQueue, QueueProcessor
+
+
+def route_by_document(op, shards):
+    """Routes operations on a stable hash of the document id.
+    """
+    return (zlib.crc32(str(op.document_id)) & 0xffffffff) % shards
+
+
+def route_by_resolver(schemes, default=0):
+    """Returns a router sending the operations to a shard depending on
+    their resolver: `schemes` maps resolver names to shard indexes.
+    """
+    def route(op, shards):
+        return schemes.get(op.resolver_id or '', default)
+    return route
+
+
+class ShardedQueue(object):
+    """Routes the operations put in it to the queues of the shards.
+    """
+
+    def __init__(self, queues, router=route_by_document):
+        self.queues = queues
+        self.router = router
+
+    def put(self, op, block=True, timeout=None):
+        self.queues[self.router(op, len(self.queues))].put(
+            op, block, timeout)
+
+    def put_nowait(self, op):
+        self.put(op, False)
+
+    def put_many(self, ops):
+        shards = {}
+        for op in ops:
+            shards.setdefault(
+                self.router(op, len(self.queues)), []).append(op)
+        for number, shard_ops in shards.items():
+            self.queues[number].put_many(shard_ops)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def empty(self):
+        for q in self.queues:
+            if not q.empty():
+                return False
+        return True
+
+    def status(self):
+        return dict(shards=[q.status() for q in self.queues])
+
+    @property
+    def position(self):
+        """The number of operations indexed, over all the shards.
+        """
+        return sum(getattr(q, 'position', 0) for q in self.queues)
+
+    @property
+    def coalesced(self):
+        return sum(getattr(q, 'coalesced', 0) for q in self.queues)
+
+    def oldest(self):
+        """Returns when the oldest operation waiting in a shard was
+        queued.
+        """
+        queued = [q.oldest() for q in self.queues]
+        queued = [when for when in queued if when is not None]
+        return queued and min(queued) or None
+
+    def mark(self, ops):
+        marks = {}
+        for op in ops:
+            shard = self.router(op, len(self.queues))
+            marks[shard] = max(marks.get(shard, 0), op.seq)
+        return marks
+
+    def wait(self, marks, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for shard, mark in marks.items():
+            if timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+            if not self.queues[shard].wait(mark, timeout):
+                return False
+        return True
+
+    def sync(self):
+        for q in self.queues:
+            q.sync()
+
+    def close(self):
+        for q in self.queues:
+            q.close()
+
+
+class ShardedIndex(object):
+    """Indexes to several databases, with one writer each.
+    """
+
+    def __init__(self, connections, router=route_by_document,
+                 index_paths=None, queues=None):
+        self.connections = connections
+        # ie. a journal queue per shard
+        self.queues = queues or [IndexQueue() for c in connections]
+        self.queue = ShardedQueue(self.queues, router)
+        index_paths = index_paths or [None] * len(connections)
+        self.processors = [
+            QueueProcessor(connection, index_path=index_path, queue=q)
+            for connection, index_path, q
+            in zip(connections, index_paths, self.queues)]
+
+    def start(self):
+        queue.set_queue(self.queue)
+        for processor in self.processors:
+            processor.spawn()
+
+    def stop(self):
+        for processor in self.processors:
+            processor.halt()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Iterating over large result sets.
+
+`IndexSearch.search` detaches its results with their stored fields,
+which is fine for a page of results but not to export every match of a
+query. A `ResultStream` fetches the matches `window` by window instead,
+and loads the stored fields of a result only when its `data` is used:
+
+  for result in search_connections.stream(u'elephant', window=500):
+      write(result.id, result.data['title'])
+
+With `prefetch`, the next window is searched in a background thread
+while the current one is consumed. The stream searches a connection of
+its own, closed once iterated, so its windows come from the same
+revision of the index. The `data` of a result is to be used while
+iterating: it can't be loaded anymore once the stream is closed, and
+raises `StreamClosed` instead.
+"""
+
+import threading
+import xapian
+
+from dolmen.xapian.results import get_resolver, resolver_of
+from dolmen.xapian.search import open_connection
+
+
+class StreamClosed(Exception):
+    """The stored fields of a result can't be loaded, its stream closed
+    its connection.
+    """
+
+
+class LazyResult(object):
+    """A search result loading its stored fields on access.
+    """
+    __slots__ = ('id', 'rank', 'weight', 'percent', '_result', '_stream',
+                 '_connection', '_data')
+
+    def __init__(self, result, stream):
+        self.id = result.id
+        self.rank = result.rank
+        self.weight = getattr(result, 'weight', None)
+        self.percent = getattr(result, 'percent', None)
+        self._result = result
+        self._stream = stream
+        # a stream iterated again opens another connection
+        self._connection = stream.connection
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            # the connection is shared with the stream
+            lock = self._stream.lock
+            lock.acquire()
+            try:
+                if (self._stream.closed or
+                    self._stream.connection is not self._connection):
+                    raise StreamClosed(
+                        "The data of result %r was not loaded while "
+                        "iterating, and its stream is closed" % self.id)
+                self._data = dict(self._result.data)
+            finally:
+                lock.release()
+            self._result = self._stream = self._connection = None
+        return self._data
+
+    @property
+    def resolver_id(self):
+        return resolver_of(self)
+
+    def object(self):
+        return get_resolver(self.resolver_id).resolve(self.id)
+
+
+class Fetcher(threading.Thread):
+    """Fetches a window in the background.
+    """
+
+    def __init__(self, fetch, start):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.fetch = fetch
+        self.start_rank = start
+        self.results = self.error = None
+
+    def run(self):
+        try:
+            self.results = self.fetch(self.start_rank)
+        except Exception, error:
+            self.error = error
+
+    def get(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+
+class ResultStream(object):
+    """Iterates over the matches of a query, `window` at a time, up to
+    `limit` matches when given.
+    """
+
+    def __init__(self, index_path, query, window=100, prefetch=False,
+                 limit=None, **options):
+        self.index_path = index_path
+        self.query = query
+        self.window = window
+        self.prefetch = prefetch
+        self.limit = limit
+        self.options = options
+        self.lock = threading.Lock()
+        self.connection = None
+        self.closed = False
+        self.matches_estimated = None
+
+    def fetch(self, start):
+        """Returns the results ranked from `start`, within the window.
+        """
+        end = start + self.window
+        if self.limit is not None:
+            end = min(end, self.limit)
+        self.lock.acquire()
+        try:
+            try:
+                results = self.connection.search(
+                    self.query, start, end, **self.options)
+            except xapian.DatabaseModifiedError:
+                # the writer went too far ahead, the ranks may shift
+                self.connection.reopen()
+                results = self.connection.search(
+                    self.query, start, end, **self.options)
+            if self.matches_estimated is None:
+                self.matches_estimated = getattr(
+                    results, 'matches_estimated', None)
+            return [LazyResult(result, self) for result in results]
+        finally:
+            self.lock.release()
+
+    def last(self, start, results):
+        """Tells if the window fetched from `start` is the last one.
+        """
+        return (len(results) < self.window or
+                (self.limit is not None and start + self.window >= self.limit))
+
+    def __iter__(self):
+        self.connection = open_connection(self.index_path)
+        self.closed = False
+        if isinstance(self.query, basestring):
+            self.query = self.connection.query_parse(self.query)
+        fetcher = None
+        start = 0
+        try:
+            results = self.fetch(start)
+            while True:
+                last = self.last(start, results)
+                if self.prefetch and not last:
+                    fetcher = Fetcher(self.fetch, start + self.window)
+                    fetcher.start()
+                for result in results:
+                    yield result
+                if last:
+                    return
+                start += self.window
+                if fetcher is not None:
+                    results, fetcher = fetcher.get(), None
+                else:
+                    results = self.fetch(start)
+        finally:
+            if fetcher is not None:
+                fetcher.join()
+            self.lock.acquire()
+            try:
+                self.connection.close()
+                self.closed = True
+            finally:
+                self.lock.release()
@@ -18,7 +18,7 @@ def objectAdded(object, event):
 def objectModified(object, event):
     if removeSecurityProxy:
         object = removeSecurityProxy(object)    
-    IOperationFactory(object).modify()
+    IOperationFactory(object).modify(event.descriptions)
 
 
 @grok.subscribe(IIndexable, IObjectRemovedEvent)
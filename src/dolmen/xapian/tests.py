@@ -9,6 +9,7 @@ import interfaces
 from zope.testing import doctest
 from zope.testing.doctestunit import DocFileSuite
 from zope import interface, component
+from zope.component.testing import setUp, tearDown
 from zope.component.testlayer import ZCMLFileLayer
 from zope.component.eventtesting import setUp as EventSetup
 
@@ -37,5 +38,12 @@ def test_suite():
     readme.layer = DolmenXapianLayer(dolmen.xapian)
     suite = unittest.TestSuite()
     suite.addTest(readme)
+    for filename in ('queue.txt', 'processor.txt', 'journal.txt',
+                     'daemon.txt', 'stream.txt', 'reindex.txt',
+                     'asyncsearch.txt', 'cache.txt', 'results.txt',
+                     'shard.txt', 'pipeline.txt'):
+        suite.addTest(DocFileSuite(
+            filename, globs=globs, setUp=setUp, tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS))
     return suite
 